@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+#
+# Builds a synthetic Galaxy database with the tables the stats scripts query, for benchmarking.
+#
+# The create times are skewed towards the time of generation (the usage of a
+# Galaxy server grows over the years) and follow the working hours, users are
+# zipf like distributed and unfinished jobs are recent ones.
+
+import argparse
+import re
+import sys
+
+import psycopg2
+
+SCHEMA = """
+DROP TABLE IF EXISTS bench_meta, job, dataset, history_dataset_association, job_to_output_dataset,
+                     workflow_invocation, nels_export_tracking, nels_import_tracking;
+
+CREATE TABLE bench_meta (generated timestamp, jobs bigint, years int, seed float);
+
+CREATE TABLE job (id bigserial PRIMARY KEY, create_time timestamp, update_time timestamp, state varchar(64),
+                  tool_id varchar(255), user_id integer, handler varchar(255), destination_id varchar(255));
+
+CREATE TABLE dataset (id bigserial PRIMARY KEY, create_time timestamp, update_time timestamp, state varchar(64),
+                      file_size numeric(15, 0), total_size numeric(15, 0));
+
+CREATE TABLE history_dataset_association (id bigserial PRIMARY KEY, dataset_id bigint, create_time timestamp,
+                                          update_time timestamp, extension varchar(64));
+
+CREATE TABLE job_to_output_dataset (id bigserial PRIMARY KEY, job_id bigint, dataset_id bigint, name varchar(255));
+
+CREATE TABLE workflow_invocation (id bigserial PRIMARY KEY, create_time timestamp, update_time timestamp, state varchar(64));
+
+CREATE TABLE nels_export_tracking (id bigserial PRIMARY KEY, create_time timestamp, update_time timestamp, instance varchar(255));
+
+CREATE TABLE nels_import_tracking (id bigserial PRIMARY KEY, create_time timestamp, update_time timestamp);
+"""
+
+# the indexes a stock Galaxy has on these columns
+INDEXES = """
+CREATE INDEX ix_job_state ON job (state);
+CREATE INDEX ix_job_tool_id ON job (tool_id);
+CREATE INDEX ix_job_user_id ON job (user_id);
+CREATE INDEX ix_job_update_time ON job (update_time);
+CREATE INDEX ix_dataset_state ON dataset (state);
+CREATE INDEX ix_dataset_update_time ON dataset (update_time);
+CREATE INDEX ix_history_dataset_association_dataset_id ON history_dataset_association (dataset_id);
+CREATE INDEX ix_job_to_output_dataset_job_id ON job_to_output_dataset (job_id);
+CREATE INDEX ix_job_to_output_dataset_dataset_id ON job_to_output_dataset (dataset_id);
+CREATE INDEX ix_workflow_invocation_update_time ON workflow_invocation (update_time);
+"""
+
+TOOLS = ['upload1', 'upload1', 'cat1', '__DATA_FETCH__',
+         'toolshed.g2.bx.psu.edu/repos/devteam/fastqc/fastqc/0.73',
+         'toolshed.g2.bx.psu.edu/repos/devteam/fastqc/fastqc/0.72',
+         'toolshed.g2.bx.psu.edu/repos/devteam/bwa/bwa_mem/0.7.17.1',
+         'toolshed.g2.bx.psu.edu/repos/iuc/samtools_sort/samtools_sort/2.0.3',
+         'toolshed.g2.bx.psu.edu/repos/iuc/featurecounts/featurecounts/2.0.1',
+         'toolshed.g2.bx.psu.edu/repos/iuc/multiqc/multiqc/1.11',
+         'toolshed.g2.bx.psu.edu/repos/bgruening/trim_galore/trim_galore/0.6.7',
+         'toolshed.g2.bx.psu.edu/repos/iuc/hisat2/hisat2/2.2.1']
+
+EXTENSIONS = ['fastqsanger.gz', 'fastqsanger', 'bam', 'txt', 'tabular', 'vcf', 'html', 'fasta']
+
+
+def scale(value:str) -> int:
+    ''' 50M, 10k, 1000 -> number '''
+    g = re.match(r'^(\d+)([kKmM]?)$', value)
+    if g is None:
+        raise argparse.ArgumentTypeError(f"invalid scale {value}, valid examples: 100k 1M 50M")
+
+    num, unit = g.groups()
+    return int(num) * {'': 1, 'k': 1000, 'K': 1000, 'm': 1000000, 'M': 1000000}[unit]
+
+
+def sql_array(values:list) -> str:
+    return "ARRAY[{}]".format(", ".join([f"'{v}'" for v in values]))
+
+
+def create_time(years:int) -> str:
+    # 1 - sqrt skews the days towards now, most of the jobs are started in working hours
+    day = f"date_trunc('day', generated - (1 - sqrt(random())) * {years} * 365 * INTERVAL '1 day')"
+    hour = "(CASE WHEN random() < 0.7 THEN 7 + 11 * (random() + random()) / 2 ELSE 24 * random() END)"
+    return f"least({day} + {hour} * INTERVAL '1 hour', generated - random() * INTERVAL '1 minute')"
+
+
+def generate(cur, jobs:int, years:int, users:int, seed:float) -> None:
+
+    cur.execute(SCHEMA)
+    cur.execute("SELECT setseed(%s)", (seed,))
+    # galaxy keeps its times in UTC, whatever the time zone of the server
+    cur.execute("INSERT INTO bench_meta VALUES (date_trunc('second', now() AT TIME ZONE 'UTC'), %s, %s, %s)", (jobs, years, seed))
+
+    print(f"jobs: {jobs}", file=sys.stderr)
+    cur.execute(f"""
+        INSERT INTO job (create_time, update_time, state, tool_id, user_id, handler, destination_id)
+        SELECT ct, least(ct + random() * INTERVAL '3 hours', generated),
+               CASE WHEN generated - ct < INTERVAL '1 day' AND r < 0.3 THEN (ARRAY['queued', 'running', 'new'])[1 + floor(random() * 3)]
+                    WHEN r < 0.85 THEN 'ok' WHEN r < 0.95 THEN 'error' ELSE 'deleted' END,
+               ({sql_array(TOOLS)})[1 + floor(random() * {len(TOOLS)})],
+               1 + floor(power({users}, random()))::int - 1,
+               'handler_' || floor(random() * 4), (ARRAY['slurm', 'slurm_big', 'local'])[1 + floor(random() * 3)]
+        FROM (SELECT generated, {create_time(years)} AS ct, random() AS r FROM bench_meta, generate_series(1, {jobs})) AS jobs
+        ORDER BY ct""")
+
+    print("datasets", file=sys.stderr)
+    cur.execute("""
+        INSERT INTO dataset (create_time, update_time, state, file_size, total_size)
+        SELECT create_time, update_time, CASE WHEN state IN ('ok', 'error', 'deleted') THEN 'ok' ELSE 'queued' END,
+               size, CASE WHEN random() < 0.1 THEN NULL ELSE size END
+        FROM (SELECT job.*, floor(power(10, 3 + random() * 7))::numeric AS size
+              FROM job, generate_series(1, 1 + (random() < 0.3 AND job.id > 0)::int)) AS outputs
+        ORDER BY create_time""")
+
+    print("history dataset associations", file=sys.stderr)
+    cur.execute(f"""
+        INSERT INTO history_dataset_association (dataset_id, create_time, update_time, extension)
+        SELECT id, create_time, update_time, ({sql_array(EXTENSIONS)})[1 + floor(random() * {len(EXTENSIONS)})]
+        FROM dataset ORDER BY id""")
+
+    # outputs are matched to the jobs by create time, close enough for the joins the stats do
+    print("job outputs", file=sys.stderr)
+    cur.execute("""
+        INSERT INTO job_to_output_dataset (job_id, dataset_id, name)
+        SELECT job.id, hda.id, 'output'
+        FROM (SELECT id, row_number() OVER (ORDER BY id) AS n FROM job) AS job
+        JOIN (SELECT id, (row_number() OVER (ORDER BY id) - 1) * (SELECT count(*) FROM job) / (SELECT count(*) FROM dataset) + 1 AS n
+              FROM history_dataset_association) AS hda ON hda.n = job.n""")
+
+    print("workflows", file=sys.stderr)
+    cur.execute(f"""
+        INSERT INTO workflow_invocation (create_time, update_time, state)
+        SELECT ct, ct + INTERVAL '1 minute', 'scheduled'
+        FROM (SELECT {create_time(years)} AS ct FROM bench_meta, generate_series(1, {max(jobs // 50, 1)})) AS invocations
+        ORDER BY ct""")
+
+    print("nels tracking", file=sys.stderr)
+    cur.execute(f"""
+        INSERT INTO nels_export_tracking (create_time, update_time, instance)
+        SELECT ct, ct, (ARRAY['usegalaxy.no', 'usegalaxy.uib.no', 'test.usegalaxy.no'])[1 + floor(random() * 3)]
+        FROM (SELECT {create_time(years)} AS ct FROM bench_meta, generate_series(1, {max(jobs // 1000, 1)})) AS exports""")
+    cur.execute(f"""
+        INSERT INTO nels_import_tracking (create_time, update_time)
+        SELECT ct, ct FROM (SELECT {create_time(years)} AS ct FROM bench_meta, generate_series(1, {max(jobs // 2000, 1)})) AS imports""")
+
+    print("indexes", file=sys.stderr)
+    cur.execute(INDEXES)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='synthetic galaxy database for benchmarking the stats scripts')
+    parser.add_argument('-d', '--db-url', required=True, help="database to (re)create the tables in, eg postgresql://localhost/galaxy_bench")
+    parser.add_argument('-j', '--jobs', default=scale("1M"), type=scale, help="number of jobs, eg 1M 10M 50M")
+    parser.add_argument('-y', '--years', default=5, type=int, help="years of history")
+    parser.add_argument('-U', '--users', default=5000, type=int, help="number of users")
+    parser.add_argument('-s', '--seed', default=0.42, type=float, help="random seed, between -1 and 1")
+
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.db_url)
+    with conn:
+        with conn.cursor() as cur:
+            generate(cur, args.jobs, args.years, args.users, args.seed)
+
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("VACUUM ANALYZE")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+#
+# Times the stats commands and a historic backfill against a database made by make_galaxy_db.py
+#
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import psycopg2
+
+BIN_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "bin"))
+
+STATS = os.path.join(BIN_DIR, "galaxy_stats.py")
+HISTORIC = os.path.join(BIN_DIR, "galaxy_stats_historic.py")
+
+
+def benchmarks(config_file:str, state_file:str, events_dir:str, start:str, end:str) -> []:
+    ''' name and command line of every benchmark '''
+    stats = [sys.executable, STATS, "-c", config_file]
+    historic = [sys.executable, HISTORIC, "-c", config_file, "-s", start, "-e", end, "-i", "1d", "-r", "1h"]
+    return [
+        ('stats', stats + ["stats"]),
+        ('stats-snapshot', stats + ["--snapshot", "stats"]),
+        ('stats-parallel', stats + ["--parallel", "4", "stats"]),
+        ('stats-incremental', stats + ["--snapshot", "--incremental", state_file, "stats"]),
+        ('stats-users', stats + ["stats", "users"]),
+        ('stats-jobs', stats + ["stats", "jobs"]),
+        ('stats-queue', stats + ["stats", "queue"]),
+        ('stats-queue-latency', stats + ["stats", "queue", "latency"]),
+        ('stats-data', stats + ["stats", "data"]),
+        ('stats-data-month', stats + ["stats", "data", "month"]),
+        ('stats-growth', stats + ["stats", "growth"]),
+        ('historic', historic),
+        # the first run fills the cache, the others only read the new rows
+        ('historic-events', historic + ["--events", events_dir]),
+    ]
+
+
+def run(cmd:[]) -> {}:
+    start = time.time()
+    res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    duration = time.time() - start
+
+    if res.returncode != 0:
+        print(res.stderr, file=sys.stderr)
+        raise RuntimeError("{} exited with {}".format(" ".join(cmd), res.returncode))
+
+    return {'duration': duration, 'lines': len(res.stdout.splitlines())}
+
+
+def database_info(db_url:str) -> {}:
+    conn = psycopg2.connect(db_url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT generated, jobs, years, seed FROM bench_meta")
+            generated, jobs, years, seed = cur.fetchone()
+            cur.execute("SELECT version(), pg_database_size(current_database())")
+            version, size = cur.fetchone()
+    finally:
+        conn.close()
+
+    return {'generated': generated, 'jobs': jobs, 'years': years, 'seed': seed, 'postgres': version, 'size': size}
+
+
+def rebase(db_url:str) -> float:
+    ''' moves all times in the database forward by the time since it was generated, so the windows of the stats,
+    which end at now(), hold the same rows on every run. Returns the seconds they were moved by. '''
+    conn = psycopg2.connect(db_url)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT date_trunc('second', now() AT TIME ZONE 'UTC') - generated FROM bench_meta")
+            shift, = cur.fetchone()
+            # not worth rewriting the tables for
+            if shift < datetime.timedelta(minutes=1):
+                return 0
+
+            cur.execute("SELECT table_name::text, array_agg(column_name::text) FROM information_schema.columns "
+                        "WHERE table_schema = current_schema() AND data_type = 'timestamp without time zone' "
+                        "AND table_name <> 'bench_meta' GROUP BY 1")
+            for table, columns in cur.fetchall():
+                print("moving the times of {} forward by {}".format(table, shift), file=sys.stderr)
+                cur.execute("UPDATE {} SET {}".format(table, ", ".join(["{0} = {0} + %(shift)s".format(column) for column in columns])),
+                            {'shift': shift})
+                # the updated rows would leave the table twice its size
+                cur.execute("VACUUM FULL ANALYZE {}".format(table))
+            cur.execute("UPDATE bench_meta SET generated = generated + %s", (shift,))
+    finally:
+        conn.close()
+
+    return shift.total_seconds()
+
+
+def git_commit() -> str:
+    res = subprocess.run(["git", "rev-parse", "HEAD"], cwd=BIN_DIR, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                         universal_newlines=True)
+    return res.stdout.strip() or None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the galaxy stats scripts')
+    parser.add_argument('-d', '--db-url', required=True, help="database made by make_galaxy_db.py")
+    parser.add_argument('-r', '--runs', default=3, type=int, help="runs per benchmark")
+    parser.add_argument('-o', '--output', default="bench_results.json", help="results file")
+    parser.add_argument('-D', '--days', default=30, type=int, help="days of historic backfill, ending at the (moved) generation time")
+    parser.add_argument('--keep-times', action='store_true', help="do not move the times of the database up to now first")
+    parser.add_argument('benchmark', nargs='*', help="benchmarks to run, default all")
+
+    args = parser.parse_args()
+
+    rebased = 0
+    if not args.keep_times:
+        rebased = rebase(args.db_url)
+    info = database_info(args.db_url)
+    end = info['generated'].replace(hour=0, minute=0, second=0)
+    start = end - datetime.timedelta(days=args.days)
+
+    tmp_dir = tempfile.mkdtemp(prefix="galaxy_bench")
+    config_file = os.path.join(tmp_dir, "galaxy.json")
+    with open(config_file, 'w') as outfile:
+        json.dump({'db_url': args.db_url}, outfile)
+
+    results = {'started': datetime.datetime.now().isoformat(timespec='seconds'),
+               'commit': git_commit(),
+               'python': platform.python_version(),
+               'database': dict(info, generated=info['generated'].isoformat(), rebased=rebased),
+               'historic_range': [start.isoformat(), end.isoformat()],
+               'runs': args.runs,
+               'benchmarks': {}}
+
+    for name, cmd in benchmarks(config_file, os.path.join(tmp_dir, "state.json"), os.path.join(tmp_dir, "events"),
+                                start.isoformat(), end.isoformat()):
+        if args.benchmark != [] and name not in args.benchmark:
+            continue
+
+        runs = [run(cmd) for _ in range(args.runs)]
+        durations = [entry['duration'] for entry in runs]
+        results['benchmarks'][name] = {'cmd': " ".join(cmd[1:]),
+                                       'durations': durations,
+                                       'min': min(durations),
+                                       'median': statistics.median(durations),
+                                       'max': max(durations),
+                                       'lines': runs[-1]['lines']}
+        print("{:<20} min {:8.3f}s median {:8.3f}s max {:8.3f}s {:>8} lines".format(
+            name, min(durations), statistics.median(durations), max(durations), runs[-1]['lines']), file=sys.stderr)
+
+    with open(args.output, 'w') as outfile:
+        json.dump(results, outfile, indent=2)
+        outfile.write("\n")
+
+    shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#
+# Change only emission of line protocol, with a heartbeat and a zero for series that are gone
+#
+
+import json
+import os
+import threading
+
+# tags that name the fixed period a series counts, eg the month of active-users, such a series ends with its period
+PERIOD_TAGS = ['date']
+
+
+class ChangeFilter:
+
+    """Keeps the last printed fields of every series per collector and drops the lines that repeat them.
+
+    A series is printed again when its fields change, and at least every heartbeat ticks
+    of its collector. A series that a collector no longer prints, eg a tool that left the
+    queue, is printed once more with its fields set to 0 and then forgotten. Points with
+    a time of their own, or with one of the PERIOD_TAGS, are a series per period, and are
+    not zeroed when they are gone. With a path the state is kept in a json file between
+    runs.
+    """
+
+    def __init__(self, path:str=None, heartbeat:int=10):
+        self.path = path
+        self.heartbeat = heartbeat
+        self._lock = threading.Lock()
+        self._ticks = {}
+        self._series = {}
+
+        if path is not None and os.path.isfile(path):
+            with open(path) as fh:
+                state = json.load(fh)
+            self._ticks = state.get('ticks', {})
+            self._series = state.get('series', {})
+
+    def filter(self, collector:str, text:str, complete:bool=True) -> str:
+        ''' the lines of a tick of a collector that are to be printed. An incomplete tick, eg one that
+        timed out, does not zero the series it did not get to '''
+
+        with self._lock:
+            tick = self._ticks.get(collector, 0) + 1
+            self._ticks[collector] = tick
+            previous = self._series.get(collector, {})
+            series = {}
+            lines = []
+
+            for line in text.splitlines():
+                parts = line.split()
+                if len(parts) < 2:
+                    lines.append(line)
+                    continue
+
+                key, fields = parts[0], parts[1]
+                if len(parts) > 2:
+                    key = "{} {}".format(key, parts[2])
+                last, printed = previous.get(key, (None, 0))
+                if fields != last or tick - printed >= self.heartbeat:
+                    lines.append(line)
+                    printed = tick
+                series[key] = [fields, printed]
+
+            for key, (fields, printed) in previous.items():
+                if key in series:
+                    continue
+                if not complete:
+                    series[key] = [fields, printed]
+                elif ' ' not in key and not self._periodic(key):
+                    zeros = ",".join(["{}=0".format(field.split('=', 1)[0]) for field in fields.split(',')])
+                    lines.append("{} {}".format(key, zeros))
+
+            self._series[collector] = series
+            return "".join([line + "\n" for line in lines])
+
+    def _periodic(self, key:str) -> bool:
+        tags = [tag.split('=', 1)[0] for tag in key.split(',')[1:]]
+        return any([tag in PERIOD_TAGS for tag in tags])
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+
+        with self._lock:
+            tmp_file = "{}.tmp".format(self.path)
+            with open(tmp_file, 'w') as fh:
+                json.dump({'ticks': self._ticks, 'series': self._series}, fh)
+            os.replace(tmp_file, self.path)
@@ -0,0 +1,70 @@
+#
+# Per collector intervals, the output of a collector that is not due is served from its last run
+#
+
+import json
+import os
+import random
+import threading
+
+
+def stamp(text:str, collected:float) -> str:
+    ''' adds the collection time to the lines that do not have a time of their own '''
+    timestamp = int(collected * 1000000000)
+    lines = []
+    for line in text.splitlines():
+        if len(line.split()) == 2:
+            line = "{} {}".format(line, timestamp)
+        lines.append(line + "\n")
+    return "".join(lines)
+
+
+class Schedule:
+
+    """The last output of every collector with an interval, and when it is due again.
+
+    A collector without an interval is due on every tick. The next run of a collector
+    is up to jitter (a fraction of its interval) early, a random amount every time, so
+    the expensive collectors of several collector processes drift apart instead of
+    running at the same moment. With a path the outputs are kept in a json file
+    between runs.
+    """
+
+    def __init__(self, intervals:{}, path:str=None, jitter:float=0.1):
+        self.intervals = intervals
+        self.path = path
+        self.jitter = jitter
+        self._lock = threading.Lock()
+        self._runs = {}
+
+        if path is not None and os.path.isfile(path):
+            with open(path) as fh:
+                self._runs = json.load(fh)
+
+    def due(self, name:str, now:float) -> bool:
+        with self._lock:
+            return name not in self.intervals or name not in self._runs or now >= self._runs[name]['due']
+
+    def last(self, name:str) -> (str, float):
+        ''' the output and collection time of the last run '''
+        with self._lock:
+            return self._runs[name]['text'], self._runs[name]['collected']
+
+    def store(self, name:str, text:str, collected:float) -> None:
+        if name not in self.intervals:
+            return
+
+        interval = float(self.intervals[name])
+        with self._lock:
+            self._runs[name] = {'text': text, 'collected': collected,
+                                'due': collected + interval * (1 - random.uniform(0, self.jitter))}
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+
+        with self._lock:
+            tmp_file = "{}.tmp".format(self.path)
+            with open(tmp_file, 'w') as fh:
+                json.dump(self._runs, fh)
+            os.replace(tmp_file, self.path)
@@ -0,0 +1,295 @@
+#
+# Local columnar cache of the rows the historic backfills are computed from
+#
+
+import array
+import bisect
+import itertools
+import json
+import mmap
+import os
+import zlib
+
+FINISHED_JOB_STATES = "'ok', 'error', 'deleted', 'deleted_new', 'failed', 'stopped', 'skipped'"
+FINISHED_DATASET_STATES = "'ok', 'empty', 'error', 'discarded', 'failed_metadata', 'deferred'"
+
+# the group and value of a row, the key distinct counts are over, and when a row can not change any more. The
+# aggregate is the one a backfill of the table has to ask for to be served from the cache
+TABLES = {
+    'job': {'group': "state", 'value': "1", 'key': "user_id", 'finished': f"state IN ({FINISHED_JOB_STATES})",
+            'aggregate': "count(*)"},
+    'dataset': {'group': "NULL", 'value': "coalesce(total_size, file_size, 0)", 'key': "NULL",
+                'finished': f"state IN ({FINISHED_DATASET_STATES})",
+                'aggregate': "sum(coalesce(dataset.total_size, dataset.file_size, 0))"},
+    'workflow_invocation': {'group': "NULL", 'value': "1", 'key': "NULL", 'finished': "true", 'aggregate': "count(*)"},
+    'nels_export_tracking': {'group': "instance", 'value': "1", 'key': "NULL", 'finished': "true", 'aggregate': "count(*)"},
+    'nels_import_tracking': {'group': "NULL", 'value': "1", 'key': "NULL", 'finished': "true", 'aggregate': "count(*)"},
+}
+
+# the layout of the files, a cache of another layout is filled again
+FORMAT = 2
+# the int64 columns kept per table, the time is the create_time in microseconds since the epoch (UTC)
+COLUMNS = ['id', 'time', 'group', 'value', 'key']
+# a NULL key
+NO_KEY = -2 ** 63
+# the group of a row that is gone from the database
+GONE = -1
+# unfinished rows are read again for this many days after they were created, a dataset that stays paused for
+# longer keeps the state it had then
+PENDING_DAYS = 7
+
+
+class EventCache:
+
+    """The id, create_time, group, value and key of the rows of the TABLES, one file of int64 per column.
+
+    update appends the rows after the highest id in the cache, and reads the recent rows
+    that were not finished yet again, eg a running job that has a new state since. Next
+    to the columns it keeps, per group, the create_times in order with the running sums
+    of the values and of the rows, and all rows in create_time order for the distinct
+    counts. The rows come about in create_time order, so an update mostly appends to
+    these. A backfill step or window is a couple of bisects on the memory mapped files.
+    """
+
+    def __init__(self, directory:str):
+        self._directory = directory
+        self._views = {}
+        os.makedirs(directory, exist_ok=True)
+
+        self._meta = {}
+        if os.path.isfile(self._path('meta.json')):
+            with open(self._path('meta.json')) as fh:
+                self._meta = json.load(fh)
+
+        # a table that was filled by another definition is filled again, columns that were appended to
+        # by an update that did not get to write its meta are cut back
+        for table, spec in TABLES.items():
+            definition = zlib.crc32(repr((FORMAT, sorted(spec.items()))).encode('utf-8'))
+            meta = self._meta.get(table)
+            if meta is None or meta['definition'] != definition:
+                meta = {'definition': definition, 'rows': 0, 'watermark': 0, 'groups': [], 'pending': [], 'ordered': False}
+                self._meta[table] = meta
+            for column in COLUMNS:
+                with open(self._path(f"{table}.{column}"), 'ab') as fh:
+                    fh.truncate(meta['rows'] * 8)
+
+            # the ordered files of an update that did not finish are made again from the columns
+            if not meta['ordered']:
+                self._reorder(table)
+
+    def _path(self, name:str) -> str:
+        return os.path.join(self._directory, name)
+
+    def _save_meta(self) -> None:
+        tmp_file = self._path('meta.json.tmp')
+        with open(tmp_file, 'w') as fh:
+            json.dump(self._meta, fh)
+        os.replace(tmp_file, self._path('meta.json'))
+
+    def _view(self, name:str) -> memoryview:
+        if name not in self._views:
+            path = self._path(name)
+            if not os.path.isfile(path) or os.path.getsize(path) == 0:
+                self._views[name] = memoryview(b'').cast('q')
+            else:
+                with open(path, 'rb') as fh:
+                    self._views[name] = memoryview(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)).cast('q')
+        return self._views[name]
+
+    def _column(self, table:str, column:str) -> memoryview:
+        return self._view(f"{table}.{column}")
+
+    def _forget(self, table:str) -> None:
+        for name in [name for name in self._views if name.startswith(f"{table}.")]:
+            del self._views[name]
+
+    def update(self, db) -> None:
+        for table in TABLES:
+            self._update(db, table)
+
+    def _update(self, db, table:str) -> None:
+        spec = TABLES[table]
+        meta = self._meta[table]
+        codes = {grp: code for code, grp in enumerate(meta['groups'])}
+        pending = {id: position for id, position in meta['pending']}
+
+        create_time = "create_time AT TIME ZONE 'UTC'"
+        finished = f"({spec['finished']}) OR {create_time} < now() - INTERVAL '{PENDING_DAYS} days'"
+        sql = f"SELECT id, (extract(epoch FROM {create_time}) * 1000000)::bigint, "
+        sql += f"{spec['group']}, {spec['value']}, {spec['key']}, {finished} FROM {table} WHERE id > {meta['watermark']}"
+        if pending:
+            sql += " OR id = ANY('{{{}}}'::bigint[])".format(",".join([str(id) for id in pending]))
+
+        appended = {column: array.array('q') for column in COLUMNS}
+        changed = []
+        unfinished = []
+        for id, created, grp, value, key, done in db.stream(sql):
+            if grp not in codes:
+                codes[grp] = len(meta['groups'])
+                meta['groups'].append(grp)
+            row = (codes[grp], int(value or 0), NO_KEY if key is None else key)
+
+            if id in pending:
+                position = pending.pop(id)
+                changed.append((position, row))
+            else:
+                position = meta['rows'] + len(appended['id'])
+                for column, value in zip(COLUMNS, (id, created) + row):
+                    appended[column].append(value)
+                meta['watermark'] = max(meta['watermark'], id)
+
+            if not done:
+                unfinished.append([id, position])
+
+        # rows that are gone do not count any more
+        for id, position in pending.items():
+            changed.append((position, (GONE, 0, NO_KEY)))
+
+        if len(appended['id']) == 0 and changed == []:
+            meta['pending'] = unfinished
+            self._save_meta()
+            return
+
+        # the group and value a changed row had, to take it out of the running sums
+        time, group, value = [self._column(table, column) for column in ['time', 'group', 'value']]
+        changed = [(position, time[position], (group[position], value[position]), row) for position, row in changed]
+
+        meta['ordered'] = False
+        self._save_meta()
+        self._forget(table)
+
+        for column in COLUMNS:
+            with open(self._path(f"{table}.{column}"), 'ab') as fh:
+                appended[column].tofile(fh)
+
+        if changed:
+            for column, index in [('group', 0), ('value', 1), ('key', 2)]:
+                with open(self._path(f"{table}.{column}"), 'r+b') as fh, mmap.mmap(fh.fileno(), 0) as mapped:
+                    view = memoryview(mapped).cast('q')
+                    for position, created, old, row in changed:
+                        view[position] = row[index]
+                    view.release()
+
+        entries = self._entries(appended, meta['rows'])
+        for position, created, (old_group, old_value), (new_group, new_value, key) in changed:
+            if (old_group, old_value) == (new_group, new_value):
+                continue
+            for code, value, rows in [(old_group, -old_value, -1), (new_group, new_value, 1)]:
+                if code != GONE:
+                    entries.setdefault(code, [array.array('q') for column in range(3)])
+                    for values, entry in zip(entries[code], (created, value, rows)):
+                        values.append(entry)
+
+        self._merge_entries(table, entries)
+        self._forget(table)
+
+        meta['rows'] += len(appended['id'])
+        meta['pending'] = unfinished
+        meta['ordered'] = True
+        self._save_meta()
+
+    def _entries(self, columns:{}, first:int) -> {}:
+        ''' the (create_time, value, 1) entries of the rows per group code, and the (create_time, position)
+        entries of all of them under 'ordered', for rows from position first on '''
+
+        entries = {'ordered': [array.array('q', columns['time']), array.array('q', range(first, first + len(columns['time'])))]}
+        for position, (created, code, value) in enumerate(zip(columns['time'], columns['group'], columns['value'])):
+            if code == GONE:
+                continue
+            if code not in entries:
+                entries[code] = [array.array('q') for column in range(3)]
+            times, values, rows = entries[code]
+            times.append(created)
+            values.append(value)
+            rows.append(1)
+        return entries
+
+    def _merge_entries(self, table:str, entries:{}) -> None:
+        for code, columns in entries.items():
+            if code == 'ordered':
+                self._merge(f"{table}.ordered", ['time', 'row'], [], columns)
+            else:
+                self._merge(f"{table}.{code}", ['time', 'total', 'rows'], ['total', 'rows'], columns)
+
+    def _reorder(self, table:str) -> None:
+        ''' makes the ordered files of a table again from its columns '''
+        for name in os.listdir(self._directory):
+            if name.startswith(f"{table}.") and name.split('.')[1] not in COLUMNS:
+                os.remove(self._path(name))
+
+        self._forget(table)
+        columns = {column: self._column(table, column) for column in COLUMNS}
+        self._merge_entries(table, self._entries(columns, 0))
+        self._forget(table)
+
+        self._meta[table]['ordered'] = True
+        self._save_meta()
+
+    def _merge(self, name:str, columns:list, running:list, entries:list) -> None:
+        ''' merges entries, an array per column, into the file per column of name that are in time order.
+        The running columns hold the running sums of the values, with a 0 in front '''
+
+        paths = [self._path(f"{name}.{column}") for column in columns]
+        size = 0
+        if os.path.isfile(paths[0]):
+            size = os.path.getsize(paths[0]) // 8
+
+        # the entries are about in time order, so usually they all come after the last one in the file
+        position = size
+        if size > 0 and len(entries[0]) > 0:
+            with open(paths[0], 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped).cast('q')
+                position = bisect.bisect_right(view, min(entries[0]))
+                view.release()
+
+        merged = []
+        bases = []
+        for column, path, values in zip(columns, paths, entries):
+            tail = array.array('q')
+            if size > 0:
+                with open(path, 'rb') as fh:
+                    fh.seek(position * 8)
+                    tail.frombytes(fh.read())
+
+            if column in running:
+                base = tail[0] if size > 0 else 0
+                tail = array.array('q', map(int.__sub__, tail[1:], tail[:-1]))
+                bases.append(base)
+            merged.append(tail + values)
+
+        order = sorted(range(len(merged[0])), key=merged[0].__getitem__)
+        for column, path, values in zip(columns, paths, merged):
+            values = array.array('q', map(values.__getitem__, order))
+            with open(path, 'ab') as fh:
+                if column not in running:
+                    fh.truncate(position * 8)
+                elif size > 0:
+                    fh.truncate((position + 1) * 8)
+                    values = array.array('q', itertools.accumulate(values, initial=bases.pop(0)))[1:]
+                else:
+                    values = array.array('q', itertools.accumulate(values, initial=bases.pop(0)))
+                values.tofile(fh)
+
+    def running_totals(self, table:str) -> {}:
+        ''' group -> (times, totals, rows) with the create_times in order, and the sum of the values and the
+        number of the rows before each '''
+
+        totals = {}
+        if TABLES[table]['group'] == "NULL":
+            totals[None] = (array.array('q'), array.array('q', [0]), array.array('q', [0]))
+        for code, grp in enumerate(self._meta[table]['groups']):
+            times = self._view(f"{table}.{code}.time")
+            if len(times) > 0:
+                totals[grp] = (times, self._view(f"{table}.{code}.total"), self._view(f"{table}.{code}.rows"))
+        return totals
+
+    def keys_between(self, table:str, after:int, before:int):
+        ''' (time, key) of the rows created after and before the times, in create_time order '''
+
+        times = self._view(f"{table}.ordered.time")
+        order = self._view(f"{table}.ordered.row")
+        key = self._column(table, 'key')
+
+        for position in range(bisect.bisect_right(times, after), bisect.bisect_left(times, before)):
+            row_key = key[order[position]]
+            yield times[position], None if row_key == NO_KEY else row_key
@@ -6,38 +6,177 @@
 # Kim Brugger (03 Apr 2019), contact: kim@brugger.dk
 
 import argparse
+import concurrent.futures
 import datetime
+import http.server
+import io
+import json
 import os
 import re
 import sys
+import threading
+import time
+import traceback
 
 import kbr.args_utils as args_utils
 import kbr.config_utils as config_utils
-import kbr.db_utils as db_utils
 import kbr.string_utils as string_utils
 
+import change_filter
+import collector_schedule
+import hll
+import index_advisor
+import instances
+import pg_pool
+import profiler
+import rollup_store
+import sketch_store
+
 DB = None
+PROFILER = None
+
+# incremental epoch totals, see get_incremental_totals
+STATE_FILE = None
+RECONCILE_INTERVAL = 3600
+
+# per hour sketches the distinct user counts are approximated from, see approx_users
+SKETCHES = None
+# hourly rollups the job, workflow, data growth and upload windows are summed from, see rollup_window
+ROLLUPS = None
+
+# drops the lines that did not change since the last tick, see run_with_budget
+CHANGES = None
+# per collector intervals from the "schedule" section of the config, see run_with_budget
+SCHEDULE = None
+
+# time budgets of the collectors in seconds, from the "timeouts" section of the config, and the default budget
+TIMEOUTS = {}
+DEFAULT_TIMEOUT = None
+# seconds a thread gets after its budget for the server side cancel to come back, before it is given up on
+TIMEOUT_GRACE = 1.0
+# series limits of the queue and nels export metrics, from the "cardinality" section of the config
+CARDINALITY = {}
+
+# with a replica_url in the config these stay on the primary, the queue has to be current
+PRIMARY_COLLECTORS = ['queue', 'queue-latency']
+
+FINISHED_JOB_STATES = ['ok', 'error', 'deleted', 'deleted_new', 'failed', 'stopped', 'skipped']
+FINISHED_DATASET_STATES = ['ok', 'empty', 'error', 'discarded', 'failed_metadata', 'deferred']
+STATE_LOCK = threading.Lock()
+
+
+def read_state() -> {}:
+    if STATE_FILE is None or not os.path.isfile(STATE_FILE):
+        return {}
+
+    with open(STATE_FILE) as fh:
+        return json.load(fh)
+
+
+def write_state(table: str, totals: {}) -> None:
+    # collectors can run concurrently, so only replace the entry of this table
+    with STATE_LOCK:
+        state = read_state()
+        state[table] = totals
+
+        tmp_file = "{}.tmp".format(STATE_FILE)
+        with open(tmp_file, 'w') as fh:
+            json.dump(state, fh)
+        os.replace(tmp_file, STATE_FILE)
+
+
+def get_incremental_totals(table: str, value: str, finished_states: list, group: str = None) -> {}:
+    ''' epoch totals of a table from the running totals in the state file and a scan of the rows after its watermark.
+
+    Rows are only added to the running totals once they are in a finished state, as
+    the values of unfinished rows still change. Unfinished rows behind the watermark
+    are kept in a pending list and looked up again on the next run. Changes to
+    finished rows (and deleted rows) are picked up by a full recount every
+    RECONCILE_INTERVAL seconds.
+    '''
+
+    totals = read_state().get(table)
+    if totals is None or time.time() - totals['reconciled'] > RECONCILE_INTERVAL:
+        totals = {'watermark': 0, 'pending': [], 'totals': {}, 'reconciled': time.time()}
+
+    finished = ", ".join(["'{}'".format(s) for s in finished_states])
+    pending = "'{{{}}}'::bigint[]".format(",".join([str(id) for id in totals['pending']]))
+    group = group or "NULL"
+
+    sql = "WITH recent AS (SELECT id, {} AS grp, {} AS value, coalesce(state, '') IN ({}) AS finished ".format(group, value, finished)
+    sql += "FROM {} WHERE id > {} OR id = ANY({})) ".format(table, totals['watermark'], pending)
+    sql += "SELECT grp, sum(value) AS total, coalesce(sum(value) FILTER (WHERE finished), 0) AS settled, "
+    sql += "max(id) AS watermark, array_agg(id) FILTER (WHERE NOT finished) AS pending FROM recent GROUP BY grp"
+
+    entries = DB.get_as_dict(sql)
+
+    # json keys are strings, so the ungrouped total is kept under ""
+    res = dict(totals['totals'])
+    totals['pending'] = []
+    for entry in entries:
+        grp = entry['grp'] or ""
+        res[grp] = res.get(grp, 0) + int(entry['total'] or 0)
+        totals['totals'][grp] = totals['totals'].get(grp, 0) + int(entry['settled'])
+        totals['watermark'] = max(totals['watermark'], int(entry['watermark']))
+        totals['pending'] += entry['pending'] or []
+
+    write_state(table, totals)
+
+    return res
+
 
+def approx_users(start: str, op: str = '>') -> int:
+    ''' distinct users with jobs created after start (a timestamptz expression) from the per hour sketches.
 
-def get_rolling_workflow_stats(month: int = None, day: int = None, hour: int = None):
+    Only the jobs of the first hour that are in the window are read from the job table,
+    the rest of the window is a merge of the sketches of its whole hours.
+    '''
+
+    bounds = DB.get_as_dict("SELECT extract(epoch FROM {})::float8 AS start, extract(epoch FROM now())::float8 AS now".format(start))[0]
+    first = int(bounds['start'] // 3600) + 1
+    SKETCHES.update(DB, first - 1)
+
+    sql = "SELECT DISTINCT user_id FROM job WHERE job.create_time AT TIME ZONE 'UTC' {} to_timestamp({}) ".format(op, bounds['start'])
+    sql += "AND job.create_time AT TIME ZONE 'UTC' < to_timestamp({}) AND user_id IS NOT NULL".format(first * 3600)
+    sketch = SKETCHES.sketch([entry['user_id'] for entry in DB.get_as_dict(sql)])
+
+    return sketch.merge(SKETCHES.union(first, int(bounds['now'] // 3600))).count()
+
+
+def rollup_window(name: str, interval: str) -> {}:
+    ''' group -> value over the window from the hourly rollups, None without rollups or if they do not cover it '''
+    if ROLLUPS is None or interval is None:
+        return None
+    return ROLLUPS.window(DB, name, "now() - '{}'::INTERVAL".format(interval))
+
+
+def get_rolling_workflow_stats(month: int = None, day: int = None, hour: int = None, entries: list = None):
 
 
     sql = "select count(distinct(id))  from workflow_invocation "
     timeframe = "timeframe=epoch,"
+    interval = None
 
 
     if month is not None:
-        sql += "WHERE create_time AT TIME ZONE 'UTC' > (now() - '{} month'::INTERVAL);".format(month)
+        interval = "{} month".format(month)
         timeframe = "timeframe=month,size={}".format(month)
     elif day is not None:
-        sql += "WHERE create_time AT TIME ZONE 'UTC' > (now() - '{} day'::INTERVAL);".format(day)
+        interval = "{} day".format(day)
         timeframe = "timeframe=day,size={}".format(day)
     elif hour is not None:
-        sql += "WHERE create_time AT TIME ZONE 'UTC' > (now() - '{} hour'::INTERVAL);".format(hour)
+        interval = "{} hour".format(hour)
         timeframe = "timeframe=hour,size={}".format(hour)
 
+    if interval is not None:
+        sql += "WHERE create_time AT TIME ZONE 'UTC' > (now() - '{}'::INTERVAL);".format(interval)
 
-    entries = DB.get_as_dict(sql)
+    if entries is None:
+        totals = rollup_window('workflows', interval)
+        if totals is not None:
+            entries = [{'count': totals.get("", 0)}]
+    if entries is None:
+        entries = DB.get_as_dict(sql)
     if entries == None or entries == []:
         entries = [{'count': 0, "state":"ok"}]
 
@@ -68,23 +207,38 @@ def stats_rolling_workflows(args):
 
 
 
-def get_data_growth(month:int=None, day:int=None, hour:int=None):
+def get_data_growth(month:int=None, day:int=None, hour:int=None, entries:list=None):
     sql = "SELECT sum(coalesce(dataset.total_size, dataset.file_size, 0)) AS size FROM dataset  "
 
     timeframe = "timeframe=epoch"
+    interval = None
 
     if month is not None:
-        sql += "WHERE update_time > now() - INTERVAL '{} month' ".format(month)
+        interval = "{} month".format(month)
         timeframe = "timeframe=month,size={}".format(month)
     elif hour is not None:
-        sql += "WHERE update_time > now() - INTERVAL '{} hour' ".format(hour)
+        interval = "{} hour".format(hour)
         timeframe = "timeframe=hour,size={}".format(hour)
     elif day is not None:
-        sql += "WHERE update_time > now() - INTERVAL '{} day' ".format(day)
+        interval = "{} day".format(day)
         timeframe = "timeframe=day,size={}".format(day)
 
+    if interval is not None:
+        sql += "WHERE update_time > now() - INTERVAL '{}' ".format(interval)
+
+    if entries is None and STATE_FILE is not None and timeframe == "timeframe=epoch":
+        totals = get_incremental_totals('dataset', 'coalesce(dataset.total_size, dataset.file_size, 0)', FINISHED_DATASET_STATES)
+        entries = [{'size': totals.get("", 0)}]
+
+    if entries is None:
+        totals = rollup_window('growth', interval)
+        if totals is not None:
+            entries = [{'size': totals.get("", 0)}]
 
-    for entry in DB.get_as_dict(sql):
+    if entries is None:
+        entries = DB.get_as_dict(sql)
+
+    for entry in entries:
         if entry["size"] == None:
             entry['size'] = 0
         print("data_growth,{}\tsize={}".format(timeframe, entry["size"]))
@@ -119,27 +273,39 @@ def stats_growth(args):
 
 
 
-def get_job_stats(month: int= None, day: int = None, hour: int = None):
+def get_job_stats(month: int= None, day: int = None, hour: int = None, entries: list = None):
     sql = "SELECT state, count(*) from job "
 
     timeframe = "timeframe=epoch,"
+    interval = None
 
 
     if month is not None:
-        sql += "WHERE update_time > now() - INTERVAL '{} month' ".format(month)
+        interval = "{} month".format(month)
         timeframe = "timeframe=month,size={},".format(month)
     elif hour is not None:
-        sql += "WHERE update_time > now() - INTERVAL '{} hour' ".format(hour)
+        interval = "{} hour".format(hour)
         timeframe = "timeframe=hour,size={},".format(hour)
     elif day is not None:
-        sql += "WHERE update_time > now() - INTERVAL '{} day' ".format(day)
+        interval = "{} day".format(day)
         timeframe = "timeframe=day,size={},".format(day)
 
+    if interval is not None:
+        sql += "WHERE update_time > now() - INTERVAL '{}' ".format(interval)
     sql += "GROUP BY state"
 
     total = 0
 
-    entries = DB.get_as_dict(sql)
+    if entries is None and STATE_FILE is not None and timeframe == "timeframe=epoch,":
+        totals = get_incremental_totals('job', '1', FINISHED_JOB_STATES, group='state')
+        entries = [{'state': state, 'count': count} for state, count in totals.items() if count > 0]
+
+    if entries is None:
+        totals = rollup_window('jobs', interval)
+        if totals is not None:
+            entries = [{'state': state, 'count': count} for state, count in sorted(totals.items()) if count > 0]
+    if entries is None:
+        entries = DB.get_as_dict(sql)
     if entries == None or entries == []:
         entries = [{'count': 0, "state":"ok"}]
 
@@ -180,25 +346,31 @@ def stats_jobs(args):
 
 
 
-def get_rolling_user_stats(month: int = None, day: int = None, hour: int = None):
+def get_rolling_user_stats(month: int = None, day: int = None, hour: int = None, entries: list = None):
 
 
     sql = "select count(distinct(user_id))  from job "
     timeframe = "timeframe=epoch,"
+    interval = None
 
 
     if month is not None:
-        sql += "WHERE job.create_time AT TIME ZONE 'UTC' > (now() - '{} month'::INTERVAL);".format(month)
+        interval = "{} month".format(month)
         timeframe = "timeframe=month,size={}".format(month)
     elif day is not None:
-        sql += "WHERE job.create_time AT TIME ZONE 'UTC' > (now() - '{} day'::INTERVAL);".format(day)
+        interval = "{} day".format(day)
         timeframe = "timeframe=day,size={}".format(day)
     elif hour is not None:
-        sql += "WHERE job.create_time AT TIME ZONE 'UTC' > (now() - '{} hour'::INTERVAL);".format(hour)
+        interval = "{} hour".format(hour)
         timeframe = "timeframe=hour,size={}".format(hour)
 
+    if interval is not None:
+        sql += "WHERE job.create_time AT TIME ZONE 'UTC' > (now() - '{}'::INTERVAL);".format(interval)
 
-    entries = DB.get_as_dict(sql)
+    if entries is None and SKETCHES is not None and interval is not None:
+        entries = [{'count': approx_users("now() - '{}'::INTERVAL".format(interval))}]
+    if entries is None:
+        entries = DB.get_as_dict(sql)
     if entries == None or entries == []:
         entries = [{'count': 0, "state":"ok"}]
 
@@ -207,29 +379,44 @@ def get_rolling_user_stats(month: int = None, day: int = None, hour: int = None)
 
 
 
-def get_nels_exports():
-    sql="SELECT count(*), instance FROM nels_export_tracking GROUP BY instance;"
+def nels_exports_sql() -> str:
+    ''' the exports per instance, with the instances beyond the top_instances of the config as instance=other '''
+    top = CARDINALITY.get('top_instances')
+    if top is None:
+        return "SELECT count(*), instance FROM nels_export_tracking GROUP BY instance"
 
+    sql = "SELECT count(*), CASE WHEN instance IN (SELECT instance FROM nels_export_tracking GROUP BY 1 "
+    sql += "ORDER BY count(*) DESC, 1 LIMIT {}) THEN instance ELSE 'other' END AS instance ".format(int(top))
+    sql += "FROM nels_export_tracking GROUP BY 2"
+    return sql
 
-    entries = DB.get_as_dict(sql)
+
+def get_nels_exports(entries: list = None):
+    sql = nels_exports_sql()
+
+    if entries is None:
+        entries = DB.get_as_dict(sql)
     for entry in entries:
         print("nels-exports,instance={instance}\tcount={count}".format(instance=entry['instance'], count=entry['count']))
+    print_series_count('nels-exports', len(entries))
 
 
-def get_nels_imports():
+def get_nels_imports(entries: list = None):
     sql="select count(*) from nels_import_tracking;"
 
 
-    entries = DB.get_as_dict(sql)
+    if entries is None:
+        entries = DB.get_as_dict(sql)
     for entry in entries:
         print("nels-imports\tcount={count}".format(count=entry['count']))
 
-def get_workflow_stats():
+def get_workflow_stats(entries: list = None):
     sql="select count(*) AS count  from workflow_invocation"
 
 
 
-    entries = DB.get_as_dict(sql)
+    if entries is None:
+        entries = DB.get_as_dict(sql)
     for entry in entries:
         print(f"workflows,timeframe=epoc count={entry['count']}")
 
@@ -260,7 +447,7 @@ def stats_rolling_users(args):
         sys.exit()
 
 
-def get_user_stats(year: int = None, month: str = None):
+def get_user_stats(year: int = None, month: str = None, entries: list = None):
     # default we show for the current month
     today = datetime.datetime.today()
     where = "WHERE date_trunc('month', job.create_time AT TIME ZONE 'UTC') = '{}-{}-01'::date ".format(today.year,
@@ -279,7 +466,14 @@ def get_user_stats(year: int = None, month: str = None):
 
     #    print( q )
 
-    for entry in DB.get_as_dict(sql):
+    if entries is None and SKETCHES is not None and year is None and month is None:
+        this_month = datetime.date(today.year, today.month, 1)
+        count = approx_users("'{}'::date::timestamptz".format(this_month), op='>=')
+        entries = [{'month': this_month, 'count': count}] if count > 0 else []
+    if entries is None:
+        entries = DB.get_as_dict(sql)
+
+    for entry in entries:
         print("active-users,timeframe=month,size=1,date={}\tcount={}".format(entry['month'], entry['count']))
 
 
@@ -303,27 +497,146 @@ def stats_users(args):
         sys.exit()
 
 
-def get_queue_stats():
-    sql = "SELECT tool_id, state, count(*) as count FROM job "
-    sql += "WHERE state in ('queued', 'running') "
-    sql += "GROUP BY tool_id, state ORDER BY count desc"
+# the breakdowns of the queue latency, the GROUPING() of (tool_id, handler, destination_id) of each
+LATENCY_GROUPS = {3: 'tool_id', 5: 'handler', 6: 'destination_id'}
+
+
+def sql_literal(value: str) -> str:
+    return "'{}'".format(str(value).replace("'", "''"))
+
 
-    for entry in DB.get_as_dict(sql):
-        entry['tool_id'] = re.sub(r'^.*repos/', '', entry['tool_id'])
-        print("queue,tool_id={},state={} count={}".format(entry['tool_id'], entry['state'], entry['count']))
+def matches_any(column: str, patterns: list) -> str:
+    return "{} ~ ANY(ARRAY[{}]::text[])".format(column, ", ".join([sql_literal(pattern) for pattern in patterns]))
+
+
+def queue_tool_id() -> str:
+    ''' the tool id without its tool shed part, so a tool from two shed urls is one group, and with strip_versions
+    without the version of shed tools '''
+    tool_id = "tool_id"
+    if CARDINALITY.get('strip_versions'):
+        tool_id = "regexp_replace(tool_id, '(repos/[^/]+/[^/]+/[^/]+)/[^/]*$', '\\1')"
+    return "regexp_replace({}, '^.*repos/', '')".format(tool_id)
+
+
+def queue_jobs_sql() -> str:
+    ''' the queued and running jobs as a subquery, with the tools beyond the top_tools and those on the deny_tools
+    list as tool_id=other. Tools on the allow_tools list are always kept. '''
+
+    jobs = "SELECT {} AS tool_id, handler, destination_id, state, create_time ".format(queue_tool_id())
+    jobs += "FROM job WHERE state in ('queued', 'running')"
+
+    top = CARDINALITY.get('top_tools')
+    allow = CARDINALITY.get('allow_tools', [])
+    deny = CARDINALITY.get('deny_tools', [])
+    if top is None and deny == []:
+        return "({}) AS queue".format(jobs)
+
+    keep = "true"
+    if top is not None:
+        ranked = "true"
+        if allow != []:
+            ranked = "NOT {}".format(matches_any("tool_id", allow))
+        keep = "tool_id IN (SELECT tool_id FROM queued WHERE {} ".format(ranked)
+        if deny != []:
+            keep += "AND NOT {} ".format(matches_any("tool_id", deny))
+        keep += "GROUP BY 1 ORDER BY count(*) DESC, 1 LIMIT {})".format(int(top))
+        if allow != []:
+            keep = "({} OR {})".format(keep, matches_any("tool_id", allow))
+    if deny != []:
+        keep = "NOT {} AND {}".format(matches_any("tool_id", deny), keep)
+
+    sql = "(WITH queued AS MATERIALIZED ({}) ".format(jobs)
+    sql += "SELECT CASE WHEN {} THEN tool_id ELSE 'other' END AS tool_id, ".format(keep)
+    sql += "handler, destination_id, state, create_time FROM queued) AS queue"
+    return sql
+
+
+def print_series_count(measurement: str, count: int) -> None:
+    print("cardinality,measurement={} series={}".format(measurement, count))
+
+
+def queue_sql() -> str:
+    return "SELECT tool_id, state, count(*) AS count FROM {} GROUP BY 1, 2".format(queue_jobs_sql())
+
+
+def get_queue_stats(entries: list = None):
+    sql = queue_sql() + " ORDER BY count desc"
+
+    # a busy server has many tool and state groups, so they are printed as they come off the cursor
+    if entries is None:
+        rows = DB.stream(sql)
+    else:
+        rows = [(entry['tool_id'], entry['state'], entry['count']) for entry in entries]
+
+    series = 0
+    for tool_id, state, count in rows:
+        print("queue,tool_id={},state={} count={}".format(tool_id, state, count))
+        series += 1
+    print_series_count('queue', series)
+
+
+def queue_latency_sql() -> str:
+    ''' the wait time percentiles of the queued and running jobs per tool, handler and destination, in one scan '''
+    sql = "SELECT GROUPING(tool_id, handler, destination_id) AS grouping, "
+    sql += "CASE GROUPING(tool_id, handler, destination_id) WHEN 3 THEN tool_id WHEN 5 THEN handler ELSE destination_id END AS value, "
+    sql += "state, count(*) AS count, percentile_cont(ARRAY[0.5, 0.9, 0.99]) WITHIN GROUP (ORDER BY wait) AS wait "
+    sql += "FROM (SELECT tool_id, handler, destination_id, state, "
+    sql += "extract(epoch FROM now() - create_time AT TIME ZONE 'UTC') AS wait FROM {}) AS waits ".format(queue_jobs_sql())
+    sql += "GROUP BY GROUPING SETS ((tool_id, state), (handler, state), (destination_id, state))"
+    return sql
+
+
+def get_queue_latency_stats(entries: list = None):
+    sql = queue_latency_sql() + " ORDER BY 1, count desc"
+
+    if entries is None:
+        rows = DB.stream(sql)
+    else:
+        rows = [(entry['grouping'], entry['value'], entry['state'], entry['count'], entry['wait']) for entry in entries]
+
+    series = 0
+    for grouping, value, state, count, wait in rows:
+        # jobs that are not assigned to a handler or destination yet
+        if value is None:
+            value = "none"
+        p50, p90, p99 = [round(seconds, 1) for seconds in wait]
+        print("queue_latency,{}={},state={} count={},p50={},p90={},p99={}".format(
+            LATENCY_GROUPS[grouping], value, state, count, p50, p90, p99))
+        series += 1
+    print_series_count('queue_latency', series)
 
 
 def stats_queue(args):
-    get_queue_stats()
+    if len(args.command) > 0 and args.command[0] == 'latency':
+        get_queue_latency_stats()
+    else:
+        get_queue_stats()
 
 
-def get_upload_stats(month: int = None, day: int = None, hour: int = None):
-    sql = "SELECT coalesce(sum(dataset.total_size), 0) as size FROM job "
-    sql += "LEFT JOIN job_to_output_dataset ON job.id = job_to_output_dataset.job_id "
-    sql += "LEFT JOIN history_dataset_association ON "
-    sql += " job_to_output_dataset.dataset_id = history_dataset_association.id "
-    sql += "LEFT JOIN dataset ON history_dataset_association.dataset_id = dataset.id "
-    sql += "WHERE job.tool_id = 'upload1'"
+def stats_queue_latency(args):
+    get_queue_latency_stats()
+
+
+def stats_nels_exports(args):
+    get_nels_exports()
+
+
+def stats_nels_imports(args):
+    get_nels_imports()
+
+
+def stats_workflows(args):
+    get_workflow_stats()
+
+
+def get_upload_stats(month: int = None, day: int = None, hour: int = None, entries: list = None):
+    # the AT TIME ZONE is on the side of the window start, so the planner can use the create_time statistics
+    # and an index on it to only look at the uploads in the window
+    sql = "SELECT history_dataset_association.extension AS extension, coalesce(sum(dataset.total_size), 0) AS size "
+    sql += "FROM job JOIN job_to_output_dataset ON job.id = job_to_output_dataset.job_id "
+    sql += "JOIN history_dataset_association ON job_to_output_dataset.dataset_id = history_dataset_association.id "
+    sql += "JOIN dataset ON history_dataset_association.dataset_id = dataset.id "
+    sql += "WHERE job.tool_id = 'upload1' "
 
     timeframe = "hour"
     size = 1
@@ -337,28 +650,66 @@ def get_upload_stats(month: int = None, day: int = None, hour: int = None):
         timeframe = "hour"
         size = hour
 
-    sql += "AND job.create_time AT TIME ZONE 'UTC' > (now() - '{} {}s'::INTERVAL)".format(size, timeframe)
+    sql += "AND job.create_time > (now() - '{} {}s'::INTERVAL) AT TIME ZONE 'UTC' ".format(size, timeframe)
+    sql += "GROUP BY history_dataset_association.extension"
 
     #    print( q )
 
-    entry = DB.get_as_dict(sql)
-    count = 0
-    if entry is not None:
-        count = float(entry[0]['size'])
-        count /= 1e9
+    if entries is None:
+        totals = rollup_window('uploads', "{} {}s".format(size, timeframe))
+        if totals is not None:
+            entries = [{'extension': extension, 'size': value} for extension, value in totals.items()]
+    if entries is None:
+        entries = DB.get_as_dict(sql)
 
+    count = sum([float(entry['size']) for entry in entries]) / 1e9
     print("data-upload,timeframe={},size=1,format=GB count={}".format(timeframe, count))
 
+    for entry in sorted(entries, key=lambda entry: entry['extension'] or ""):
+        if float(entry['size']) == 0:
+            continue
+        print("data-upload-extension,timeframe={},size=1,format=GB,extension={} count={}".format(
+            timeframe, entry['extension'] or "unknown", float(entry['size']) / 1e9))
+
+
+def get_hourly_upload_stats(hours: int = 24):
+    ''' upload volume per hour and extension over the last hours, the points have the time of the start of their hour '''
+
+    now_hour = int(time.time() // 3600)
+    if ROLLUPS is not None:
+        ROLLUPS.update(DB, 'uploads')
+        entries = [{'hour': hour, 'extension': extension, 'size': value}
+                   for hour, extension, value in ROLLUPS.buckets('uploads', now_hour - hours + 1)]
+    else:
+        sql = "SELECT floor(extract(epoch FROM job.create_time AT TIME ZONE 'UTC') / 3600)::bigint AS hour, "
+        sql += "history_dataset_association.extension AS extension, coalesce(sum(dataset.total_size), 0) AS size "
+        sql += "FROM job JOIN job_to_output_dataset ON job.id = job_to_output_dataset.job_id "
+        sql += "JOIN history_dataset_association ON job_to_output_dataset.dataset_id = history_dataset_association.id "
+        sql += "JOIN dataset ON history_dataset_association.dataset_id = dataset.id "
+        sql += "WHERE job.tool_id = 'upload1' AND job.create_time >= to_timestamp({}) AT TIME ZONE 'UTC' ".format((now_hour - hours + 1) * 3600)
+        sql += "GROUP BY 1, 2 ORDER BY 1, 2"
+        entries = DB.get_as_dict(sql)
+
+    for entry in entries:
+        if float(entry['size']) == 0:
+            continue
+        print("data-upload-hourly,format=GB,extension={} count={} {}".format(
+            entry['extension'] or "unknown", float(entry['size']) / 1e9, int(entry['hour']) * 3600 * 1000000000))
+
 
 def stats_data(args):
     if len(args.command) == 0:
         get_upload_stats()
         return
 
-    commands = ['month', 'day', 'hour', 'help']
+    commands = ['month', 'day', 'hour', 'hourly', 'help']
     command = args.command.pop(0)
     args_utils.valid_command(command, commands)
 
+    if command == 'hourly':
+        get_hourly_upload_stats(int(args_utils.get_or_default(args.command, 24)))
+        return
+
     size = offset = args_utils.get_or_default(args.command, 1)
     if command == 'month':
         get_upload_stats(month=size)
@@ -371,20 +722,367 @@ def stats_data(args):
         sys.exit()
 
 
-def stats_command(args) -> None:
-    if len(args.command) == 0:
-        stats_users(args)
-#        stats_data(args)
-        stats_rolling_users(args)
-        stats_jobs(args)
-        stats_queue(args)
-        stats_rolling_workflows(args)
-        stats_growth(args)
-        get_nels_exports()
-        get_nels_imports()
-        get_workflow_stats()
+def get_snapshot_stats():
+    ''' the default stats tick in a single statement, one scan per table with all its windows as filtered aggregates '''
+
+    today = datetime.datetime.today()
+    this_month = datetime.date(today.year, today.month, 1)
+
+    # the epoch totals come from the state file in incremental mode, so only the windows are scanned
+    window = ""
+    if STATE_FILE is not None:
+        window = "WHERE update_time > now() - INTERVAL '1 month' "
+
+    # with rollups the windows are summed from them, the tables are only scanned for the epoch totals
+    epoch_scan = STATE_FILE is None or ROLLUPS is None
+
+    sql = "WITH "
+    if epoch_scan:
+        sql += "jobs AS (SELECT state, count(*) AS epoch"
+        if ROLLUPS is None:
+            sql += ", count(*) FILTER (WHERE update_time > now() - INTERVAL '1 month') AS month, "
+            sql += "count(*) FILTER (WHERE update_time > now() - INTERVAL '1 day') AS day, "
+            sql += "count(*) FILTER (WHERE update_time > now() - INTERVAL '2 hour') AS hour"
+        sql += " FROM job {}GROUP BY state), ".format(window)
+
+    # the approximate user counts come from the sketches, which saves the scan of a month of jobs
+    if SKETCHES is None:
+        sql += "users AS (SELECT "
+        sql += "count(distinct user_id) FILTER (WHERE date_trunc('month', create_time AT TIME ZONE 'UTC') = '{}'::date) AS active, ".format(this_month)
+        sql += "count(distinct user_id) FILTER (WHERE create_time AT TIME ZONE 'UTC' > (now() - '1 month'::INTERVAL)) AS month, "
+        sql += "count(distinct user_id) FILTER (WHERE create_time AT TIME ZONE 'UTC' > (now() - '1 day'::INTERVAL)) AS day, "
+        sql += "count(distinct user_id) FILTER (WHERE create_time AT TIME ZONE 'UTC' > (now() - '2 hour'::INTERVAL)) AS hour "
+        sql += "FROM job WHERE create_time AT TIME ZONE 'UTC' >= least('{}'::date, now() - '1 month'::INTERVAL)), ".format(this_month)
+
+    # with a replica the snapshot runs there, but the queue is taken from the primary
+    if not DB.has_replica:
+        sql += "queue AS ({}), ".format(queue_sql())
+        sql += "latency AS ({}), ".format(queue_latency_sql())
+
+    sql += "workflows AS (SELECT count(*) AS epoch"
+    if ROLLUPS is None:
+        sql += ", count(distinct(id)) FILTER (WHERE create_time AT TIME ZONE 'UTC' > (now() - '1 month'::INTERVAL)) AS month, "
+        sql += "count(distinct(id)) FILTER (WHERE create_time AT TIME ZONE 'UTC' > (now() - '1 day'::INTERVAL)) AS day, "
+        sql += "count(distinct(id)) FILTER (WHERE create_time AT TIME ZONE 'UTC' > (now() - '2 hour'::INTERVAL)) AS hour"
+    sql += " FROM workflow_invocation), "
+
+    if epoch_scan:
+        sql += "growth AS (SELECT sum(coalesce(dataset.total_size, dataset.file_size, 0)) AS epoch"
+        if ROLLUPS is None:
+            sql += ", sum(coalesce(dataset.total_size, dataset.file_size, 0)) FILTER (WHERE update_time > now() - INTERVAL '1 month') AS month, "
+            sql += "sum(coalesce(dataset.total_size, dataset.file_size, 0)) FILTER (WHERE update_time > now() - INTERVAL '1 day') AS day, "
+            sql += "sum(coalesce(dataset.total_size, dataset.file_size, 0)) FILTER (WHERE update_time > now() - INTERVAL '2 hour') AS hour"
+        sql += " FROM dataset {}), ".format(window)
+
+    if ROLLUPS is None:
+        sql += "uploads AS (SELECT history_dataset_association.extension AS extension, coalesce(sum(dataset.total_size), 0) AS size "
+        sql += "FROM job JOIN job_to_output_dataset ON job.id = job_to_output_dataset.job_id "
+        sql += "JOIN history_dataset_association ON job_to_output_dataset.dataset_id = history_dataset_association.id "
+        sql += "JOIN dataset ON history_dataset_association.dataset_id = dataset.id "
+        sql += "WHERE job.tool_id = 'upload1' AND job.create_time > (now() - '1 hours'::INTERVAL) AT TIME ZONE 'UTC' "
+        sql += "GROUP BY history_dataset_association.extension), "
+
+    sql += "exports AS ({}) ".format(nels_exports_sql())
+
+    sql += "SELECT "
+    if epoch_scan:
+        sql += "(SELECT json_agg(jobs) FROM jobs) AS jobs, "
+    if SKETCHES is None:
+        sql += "(SELECT row_to_json(users) FROM users) AS users, "
+    if not DB.has_replica:
+        sql += "(SELECT json_agg(queue ORDER BY count desc) FROM queue) AS queue, "
+        sql += "(SELECT json_agg(latency ORDER BY grouping, count desc) FROM latency) AS latency, "
+    sql += "(SELECT row_to_json(workflows) FROM workflows) AS workflows, "
+    if epoch_scan:
+        sql += "(SELECT row_to_json(growth) FROM growth) AS growth, "
+    if ROLLUPS is None:
+        sql += "(SELECT json_agg(uploads) FROM uploads) AS uploads, "
+    sql += "(SELECT json_agg(exports) FROM exports) AS exports, "
+    sql += "(SELECT count(*) FROM nels_import_tracking) AS imports"
+
+    snapshot = DB.get_as_dict(sql)[0]
+    jobs = snapshot.get('jobs') or []
+    workflows = snapshot['workflows']
+    growth = snapshot.get('growth')
+
+    # same order and lines as the separate queries in stats_command
+    users = snapshot.get('users')
+    if SKETCHES is not None:
+        get_user_stats()
+    else:
+        active = []
+        if users['active'] > 0:
+            active = [{'month': this_month, 'count': users['active']}]
+        get_user_stats(entries=active)
+
+    if ROLLUPS is not None:
+        get_upload_stats()
+    else:
+        get_upload_stats(entries=snapshot['uploads'] or [])
+
+    if SKETCHES is not None:
+        get_rolling_user_stats(month=1)
+        get_rolling_user_stats(day=1)
+        get_rolling_user_stats(hour=2)
+    else:
+        get_rolling_user_stats(month=1, entries=[{'count': users['month']}])
+        get_rolling_user_stats(day=1, entries=[{'count': users['day']}])
+        get_rolling_user_stats(hour=2, entries=[{'count': users['hour']}])
+
+    if STATE_FILE is not None:
+        get_job_stats()
+    else:
+        get_job_stats(entries=[{'state': job['state'], 'count': job['epoch']} for job in jobs])
+    if ROLLUPS is not None:
+        get_job_stats(day=1)
+        get_job_stats(hour=2)
+        get_job_stats(month=1)
+    else:
+        get_job_stats(day=1, entries=[{'state': job['state'], 'count': job['day']} for job in jobs if job['day'] > 0])
+        get_job_stats(hour=2, entries=[{'state': job['state'], 'count': job['hour']} for job in jobs if job['hour'] > 0])
+        get_job_stats(month=1, entries=[{'state': job['state'], 'count': job['month']} for job in jobs if job['month'] > 0])
+
+    if DB.has_replica:
+        with DB.primary():
+            get_queue_stats()
+            get_queue_latency_stats()
+    else:
+        get_queue_stats(entries=snapshot['queue'] or [])
+        get_queue_latency_stats(entries=snapshot['latency'] or [])
+
+    if ROLLUPS is not None:
+        get_rolling_workflow_stats(month=1)
+        get_rolling_workflow_stats(day=1)
+        get_rolling_workflow_stats(hour=2)
+    else:
+        get_rolling_workflow_stats(month=1, entries=[{'count': workflows['month']}])
+        get_rolling_workflow_stats(day=1, entries=[{'count': workflows['day']}])
+        get_rolling_workflow_stats(hour=2, entries=[{'count': workflows['hour']}])
+
+    if STATE_FILE is not None:
+        get_data_growth()
+    else:
+        get_data_growth(entries=[{'size': growth['epoch']}])
+    if ROLLUPS is not None:
+        get_data_growth(month=1)
+        get_data_growth(day=1)
+        get_data_growth(hour=2)
+    else:
+        get_data_growth(month=1, entries=[{'size': growth['month']}])
+        get_data_growth(day=1, entries=[{'size': growth['day']}])
+        get_data_growth(hour=2, entries=[{'size': growth['hour']}])
+
+    get_nels_exports(entries=snapshot['exports'] or [])
+    get_nels_imports(entries=[{'count': snapshot['imports']}])
+    get_workflow_stats(entries=[{'count': workflows['epoch']}])
+
+
+# the collectors of the default stats tick, in output order
+COLLECTORS = {'users': stats_users,
+              'data': stats_data,
+              'users-rolling': stats_rolling_users,
+              'jobs': stats_jobs,
+              'queue': stats_queue,
+              'queue-latency': stats_queue_latency,
+              'workflows-rolling': stats_rolling_workflows,
+              'growth': stats_growth,
+              'nels-exports': stats_nels_exports,
+              'nels-imports': stats_nels_imports,
+              'workflows': stats_workflows}
+
+
+class CollectorOutput:
+
+    """sys.stdout stand-in that keeps the prints of each collector thread in a buffer of its own."""
+
+    def __init__(self, stdout):
+        self._stdout = stdout
+        self._local = threading.local()
+
+    def capture(self, buffer: io.StringIO = None) -> io.StringIO:
+        previous = getattr(self._local, 'buffer', None)
+        self._local.buffer = buffer
+        return previous
+
+    def write(self, s: str) -> int:
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            return self._stdout.write(s)
+        return buffer.write(s)
+
+    def __getattr__(self, name):
+        return getattr(self._stdout, name)
+
+
+def collector_timeout(name: str) -> float:
+    return TIMEOUTS.get(name, DEFAULT_TIMEOUT)
+
+
+def write_output(name: str, text: str, collected: float, complete: bool) -> None:
+    if CHANGES is not None:
+        text = CHANGES.filter(name, text, complete)
+    if SCHEDULE is not None:
+        text = collector_schedule.stamp(text, collected)
+    sys.stdout.write(text)
+
+
+def run_with_budget(name: str, func, *args) -> None:
+    ''' runs a collector on the replica, unless it is one of the PRIMARY_COLLECTORS, with its queries cancelled
+    server side once its time budget is used up. The lines it printed before a timeout are kept, followed by a
+    collector point with status=timeout. With SCHEDULE a collector that is not due prints the lines of its last
+    run again, with the time of that run, and with CHANGES the lines go through its filter. '''
+
+    now = time.time()
+    if SCHEDULE is not None and not SCHEDULE.due(name, now):
+        text, collected = SCHEDULE.last(name)
+        write_output(name, text, collected, True)
         return
 
+    timeout = collector_timeout(name)
+    deadline = None
+    if timeout is not None:
+        deadline = now + timeout
+
+    buffer = None
+    if CHANGES is not None or SCHEDULE is not None:
+        buffer = io.StringIO()
+        previous = sys.stdout.capture(buffer)
+
+    complete = timed_out = False
+    DB.set_context(replica=name not in PRIMARY_COLLECTORS, deadline=deadline)
+    try:
+        if PROFILER is None:
+            func(*args)
+        else:
+            PROFILER.run(name, func, *args)
+        complete = True
+    except pg_pool.QueryCanceled:
+        timed_out = True
+    finally:
+        DB.set_context()
+        if buffer is not None:
+            sys.stdout.capture(previous)
+            # a run that did not finish is not kept, the collector is due again on the next tick
+            if complete and SCHEDULE is not None:
+                SCHEDULE.store(name, buffer.getvalue(), now)
+            write_output(name, buffer.getvalue(), now, complete)
+
+    if timed_out:
+        print("collector {} timed out after {}s".format(name, timeout), file=sys.stderr)
+        print("collector,collector={},status=timeout timeout={}".format(name, timeout))
+
+
+def run_collector(name: str) -> str:
+    buffer = io.StringIO()
+    sys.stdout.capture(buffer)
+    try:
+        run_with_budget(name, COLLECTORS[name], argparse.Namespace(command=[]))
+    finally:
+        sys.stdout.capture(None)
+
+    return buffer.getvalue()
+
+
+def run_collectors(names: list, parallel: int) -> bool:
+    ''' runs the collectors on a thread pool. The output of a collector is printed as soon as it and the
+    collectors before it are done, so the lines keep the collector order.
+
+    The queries of a collector are cancelled server side once its time budget is
+    used up. Should a collector still not be done TIMEOUT_GRACE seconds later, it is
+    given up on and only its status=timeout point is printed. Returns whether a
+    collector that was given up on is still running.
+    '''
+
+    if not isinstance(sys.stdout, CollectorOutput):
+        sys.stdout = CollectorOutput(sys.stdout)
+
+    started = {}
+
+    def run(name):
+        started[name] = time.time()
+        return run_collector(name)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=parallel)
+    futures = {executor.submit(run, name): name for name in names}
+    pending = set(futures)
+    timed_out = set()
+    ordered = list(futures.items())
+
+    def emit_finished():
+        while ordered and (ordered[0][0] in timed_out or ordered[0][0].done()):
+            future, name = ordered.pop(0)
+            if future in timed_out:
+                print("collector {} timed out after {}s".format(name, collector_timeout(name)), file=sys.stderr)
+                print("collector,collector={},status=timeout timeout={}".format(name, collector_timeout(name)))
+            elif future.exception() is not None:
+                print("collector {} failed:".format(name), file=sys.stderr)
+                error = future.exception()
+                traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+            else:
+                sys.stdout.write(future.result())
+        sys.stdout.flush()
+
+    while pending:
+        now = time.time()
+        wait = None
+        for future in list(pending):
+            name = futures[future]
+            if name not in started or collector_timeout(name) is None:
+                continue
+            limit = started[name] + collector_timeout(name) + TIMEOUT_GRACE
+            if now >= limit:
+                pending.remove(future)
+                timed_out.add(future)
+            elif wait is None or limit - now < wait:
+                wait = limit - now
+
+        # the budgets of the collectors that have not started yet are looked at again a second later
+        if len(started) < len(futures) and any([collector_timeout(name) is not None for name in names]):
+            wait = 1.0 if wait is None else min(wait, 1.0)
+
+        if pending:
+            _, pending = concurrent.futures.wait(pending, timeout=wait, return_when=concurrent.futures.FIRST_COMPLETED)
+        emit_finished()
+
+    executor.shutdown(wait=False, cancel_futures=True)
+    emit_finished()
+
+    return any([not future.done() for future in timed_out])
+
+
+def profile_tick(args) -> None:
+    if args.instrument:
+        for point in PROFILER.points():
+            print(point)
+
+    if args.profile:
+        PROFILER.report()
+        if args.explain > 0:
+            PROFILER.explain(DB, args.explain)
+
+    PROFILER.reset()
+
+
+def stats_command(args) -> bool:
+    ''' returns whether a collector that was given up on is still running '''
+    abandoned = False
+    if len(args.command) == 0:
+        if args.snapshot:
+            run_with_budget('snapshot', get_snapshot_stats)
+        elif args.parallel > 1:
+            abandoned = run_collectors(list(COLLECTORS.keys()), args.parallel)
+        else:
+            for name, collector in COLLECTORS.items():
+                run_with_budget(name, collector, args)
+
+        if CHANGES is not None:
+            CHANGES.save()
+        if SCHEDULE is not None:
+            SCHEDULE.save()
+        if PROFILER is not None:
+            profile_tick(args)
+        return abandoned
+
     commands = ['users', 'users-rolling', 'jobs', 'queue', 'data', 'growth', 'help']
 
     command = args.command.pop(0)
@@ -405,29 +1103,360 @@ def stats_command(args) -> None:
         sys.exit()
 
 
-def print_tick_entry(config_file):
+def stats_options(args) -> str:
+    ''' the stats options of this run, for the generated tick config '''
+    options = ""
+    if args.snapshot:
+        options += " --snapshot"
+    if args.incremental is not None:
+        options += " --incremental {} --reconcile {}".format(os.path.abspath(args.incremental), args.reconcile)
+    if args.parallel > 1:
+        options += " --parallel {}".format(args.parallel)
+    if args.collector_timeout is not None:
+        options += " --collector-timeout {}".format(args.collector_timeout)
+    if args.instrument:
+        options += " --instrument"
+    if args.itersize != 10000:
+        options += " --itersize {}".format(args.itersize)
+    if args.rollups is not None:
+        options += " --rollups {}".format(os.path.abspath(args.rollups))
+    if args.approx_users is not None:
+        options += " --approx-users {} --approx-error {}".format(os.path.abspath(args.approx_users), args.approx_error)
+    if args.changes_only:
+        options += " --changes-only --heartbeat {}".format(args.heartbeat)
+        if args.changes_state is not None:
+            options += " --changes-state {}".format(os.path.abspath(args.changes_state))
+    if args.schedule_state is not None:
+        options += " --schedule-state {}".format(os.path.abspath(args.schedule_state))
+    if args.schedule_jitter != 0.1:
+        options += " --schedule-jitter {}".format(args.schedule_jitter)
+
+    return options
+
+
+def schedule_entries(config:{}) -> []:
+    ''' the (collector, interval) entries of the schedule of the config and of the schedules of its instances '''
+    schedules = [config.get('schedule', {})] + [entry.get('schedule', {}) for entry in config.get('instances', {}).values()]
+    return [(name, interval) for schedule in schedules for name, interval in schedule.items()]
+
+
+def tick_interval(config:{}) -> str:
+    ''' the telegraf interval, the shortest interval of the schedule if it is shorter than a minute '''
+    seconds = min([60] + [interval for name, interval in schedule_entries(config)])
+    return "{:g}s".format(seconds) if seconds < 60 else "1m"
+
+
+def check_stats_options(parser, args, config, command: str) -> None:
+    ''' exits on the options the stats of the config can not be collected with '''
+    if command not in ['stats', 'daemon']:
+        return
+
+    # every run would start a process per instance
+    if "instances" in config and args.instance is None and command == 'stats':
+        parser.error("the config has several instances, collect their stats with the daemon (tick-config --execd) or pick one with --instance")
+
+    for name, interval in schedule_entries(config):
+        if name not in COLLECTORS:
+            parser.error("the schedule has an interval for {}, which is not one of the collectors: {}".format(name, ", ".join(COLLECTORS)))
+        if isinstance(interval, bool) or not isinstance(interval, (int, float)) or interval <= 0:
+            parser.error("the schedule interval of {} is {!r}, it should be a positive number of seconds".format(name, interval))
+
+    scheduled = "schedule" in config or any(["schedule" in entry for entry in config.get('instances', {}).values()])
+    if scheduled and args.snapshot:
+        parser.error("--snapshot collects all the stats in one query, it can not run the collectors of a schedule on their own")
+    # a stats run does not know when the collectors ran before without it
+    if scheduled and command == 'stats' and args.command == [] and args.schedule_state is None:
+        parser.error("the config has a schedule, the stats command needs a --schedule-state file for it")
+
+
+def print_tick_entry(config_file, options:str="", execd:bool=False, interval:str="1m"):
     interpreter_path = sys.executable
     script_path = os.path.realpath(__file__)
     config_file = os.path.abspath(config_file)
 
-    cmd = "{} {} -c {}".format(interpreter_path, script_path, config_file)
+    if execd:
+        cmd = [interpreter_path, script_path, "-c", config_file] + options.split() + ["daemon"]
+        entry = """[[inputs.execd]]
+   command = [{cmd}]
+   signal = 'STDIN'
+   restart_delay = '10s'
+   data_format = 'influx'
+   interval = '{interval}'
+   name_prefix='galaxy_'
+    """
+        print(entry.format(cmd=", ".join(["'{}'".format(c) for c in cmd]), interval=interval))
+        return
+
+    cmd = "{} {} -c {}{}".format(interpreter_path, script_path, config_file, options)
     entry = """[[inputs.exec]]
    commands = ['{cmd} stats']
    timeout='10s'
    data_format = 'influx'
-   interval = '1m'
+   interval = '{interval}'
    name_prefix='galaxy_' 
     """
-    entry = entry.format(cmd=cmd)
+    entry = entry.format(cmd=cmd, interval=interval)
 
     print(entry)
 
 
+def daemon_command(args) -> None:
+    ''' runs the default stats on every line read from stdin (telegraf execd signal = "STDIN"), or every
+    --interval seconds, keeping the database connection open between the ticks '''
+
+    def tick():
+        try:
+            stats_command(argparse.Namespace(**dict(vars(args), command=[])))
+        except Exception as e:
+            print("stats tick failed:", file=sys.stderr)
+            traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+        # the end of the tick for the daemon of all instances, see instances.InstanceDaemon
+        if args.instance is not None:
+            print()
+        sys.stdout.flush()
+
+    daemon_loop(args, tick)
+
+
+def instance_command(args, name: str, command: list) -> list:
+    return ([sys.executable, os.path.realpath(__file__), "-c", os.path.abspath(args.config)] + stats_options(args).split() +
+            ["--instance", name] + command)
+
+
+def instances_command(args, config) -> None:
+    ''' runs a daemon for every instance of the config, each in a process of its own with its own database
+    connections and local state files '''
+
+    daemons = [instances.InstanceDaemon(name, instance_command(args, name, ['daemon'])) for name in instances.names(config)]
+
+    def tick():
+        for daemon in daemons:
+            daemon.tick()
+
+    try:
+        daemon_loop(args, tick)
+    finally:
+        for daemon in daemons:
+            daemon.stop()
+
+
+def daemon_loop(args, tick) -> None:
+    try:
+        if args.interval is None:
+            for _ in sys.stdin:
+                tick()
+        else:
+            while True:
+                start = time.time()
+                tick()
+                time.sleep(max(0, args.interval - (time.time() - start)))
+    except KeyboardInterrupt:
+        pass
+
+
+class CachedCollector:
+
+    """Output of a collector that is refreshed at most once per ttl seconds, however many scrapes ask for it."""
+
+    def __init__(self, name: str, ttl: float):
+        self.name = name
+        self.ttl = ttl
+        self.lines = []
+        self.expires = 0
+        self._lock = threading.Lock()
+
+    def get(self) -> list:
+        if time.time() < self.expires:
+            return self.lines
+
+        with self._lock:
+            # scrapes waiting on the lock get the result of the refresh they waited for
+            if time.time() < self.expires:
+                return self.lines
+
+            try:
+                self.lines = run_collector(self.name).splitlines()
+            except Exception as e:
+                print("collector {} failed:".format(self.name), file=sys.stderr)
+                traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+            self.expires = time.time() + self.ttl
+
+        return self.lines
+
+
+EXPORTER_COLLECTORS = []
+
+
+def prometheus_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_metrics(lines: list) -> str:
+    ''' influx lines as prometheus text exposition, "jobs,timeframe=epoch,state=ok count=3" -> galaxy_jobs_count{...} 3 '''
+
+    metrics = {}
+    for line in lines:
+        series, fields = line.split(None, 1)
+        fields = fields.split()[0]
+
+        tags = series.split(',')
+        measurement = "galaxy_{}".format(re.sub(r'[^a-zA-Z0-9_]', '_', tags.pop(0)))
+        labels = []
+        for tag in tags:
+            if tag == "":
+                continue
+            key, value = tag.split('=', 1)
+            labels.append('{}="{}"'.format(key, prometheus_label(value)))
+
+        for field in fields.split(','):
+            key, value = field.split('=', 1)
+            name = "{}_{}".format(measurement, key)
+            if labels:
+                name_labels = "{}{{{}}}".format(name, ",".join(labels))
+            else:
+                name_labels = name
+            metrics.setdefault(name, []).append("{} {}".format(name_labels, value))
+
+    res = []
+    for name, samples in metrics.items():
+        res.append("# TYPE {} gauge".format(name))
+        res += samples
+
+    return "\n".join(res) + "\n"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        lines = []
+        for collector in EXPORTER_COLLECTORS:
+            lines += collector.get()
+
+        body = prometheus_metrics(lines).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def exporter_command(args, config) -> None:
+    ''' serves the default stats at /metrics in prometheus format. Every collector is cached for its
+    own ttl, from the "ttl" section of the config file, or --ttl seconds '''
+
+    if not isinstance(sys.stdout, CollectorOutput):
+        sys.stdout = CollectorOutput(sys.stdout)
+
+    ttls = config.get('ttl', {})
+    for name in COLLECTORS:
+        EXPORTER_COLLECTORS.append(CachedCollector(name, float(ttls.get(name, args.ttl))))
+
+    server = http.server.ThreadingHTTPServer((args.bind, args.port), MetricsHandler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def index_check_command(args) -> None:
+    ''' runs the collectors once, reports the sequential scans in the plans of their statements and
+    prints the indexes that are missing as sql, or creates them with --apply '''
+
+    if not isinstance(sys.stdout, CollectorOutput):
+        sys.stdout = CollectorOutput(sys.stdout)
+
+    for name, collector in COLLECTORS.items():
+        sys.stdout.capture(io.StringIO())
+        try:
+            PROFILER.run(name, collector, argparse.Namespace(command=[]))
+        finally:
+            sys.stdout.capture(None)
+
+    sys.stdout.capture(io.StringIO())
+    try:
+        PROFILER.run('snapshot', get_snapshot_stats)
+    finally:
+        sys.stdout.capture(None)
+
+    statements = {}
+    for statement in PROFILER.statements:
+        statements.setdefault(statement['sql'], []).append(statement['collector'])
+
+    scans = []
+    for sql, names in statements.items():
+        for scan in index_advisor.seq_scans(DB, sql):
+            scans.append(dict(scan, collectors=sorted(set(names))))
+
+    tables = sorted(set([index['table'] for index in index_advisor.RECOMMENDED]))
+    rows = index_advisor.table_rows(DB, tables + sorted(set([scan['table'] for scan in scans])))
+
+    print("-- sequential scans in the collector statements")
+    for scan in sorted(scans, key=lambda scan: rows.get(scan['table'], 0), reverse=True):
+        print("-- {:<20} {:>12} rows  {}  filter: {}".format(scan['table'], rows.get(scan['table'], 0),
+                                                           ",".join(scan['collectors']), scan['filter'] or "none"))
+
+    print("\n-- recommended indexes")
+    indexes = index_advisor.existing_indexes(DB, tables)
+    missing = []
+    for index in index_advisor.RECOMMENDED:
+        name = index_advisor.covering_index(index, indexes)
+        if name is not None and indexes[name]['valid']:
+            print("-- {} ({}): present as {}".format(index['name'], ",".join(index['collectors']), name))
+            continue
+
+        print("-- {} ({}):".format(index['name'], ",".join(index['collectors'])))
+        if name is not None:
+            # left behind by a failed CREATE INDEX CONCURRENTLY
+            print("DROP INDEX CONCURRENTLY {};".format(name))
+        print(index_advisor.ddl(index))
+        missing.append((name, index))
+
+    if not args.apply:
+        return
+
+    for name, index in missing:
+        if name is not None:
+            DB.get_as_dict("DROP INDEX CONCURRENTLY {}".format(name))
+        print("creating {}".format(index['name']), file=sys.stderr)
+        DB.get_as_dict(index_advisor.ddl(index))
+
+
 def main():
     parser = argparse.ArgumentParser(description='cbu galaxy admin tool')
     parser.add_argument('-c', '--config', default="galaxy.json", help="config file")
-
-    commands = ["stats", "tick-config"]
+    parser.add_argument('-S', '--snapshot', action='store_true', help="run the default stats as one consolidated query")
+    parser.add_argument('-I', '--incremental', help="state file for incremental epoch totals")
+    parser.add_argument('-R', '--reconcile', default=3600, type=int, help="seconds between full recounts of the incremental totals")
+    parser.add_argument('-P', '--parallel', default=1, type=int, help="number of collectors to run concurrently")
+    parser.add_argument('-T', '--collector-timeout', type=float, help="default time budget of a collector in seconds")
+    parser.add_argument('-i', '--interval', type=float, help="seconds between daemon ticks, default is a tick per line on stdin")
+    parser.add_argument('-E', '--execd', action='store_true', help="tick-config for the telegraf execd input and the daemon command")
+    parser.add_argument('--bind', default="", help="address the exporter listens on")
+    parser.add_argument('--port', default=9600, type=int, help="port the exporter listens on")
+    parser.add_argument('--ttl', default=60, type=float, help="seconds the exporter caches a collector's metrics")
+    parser.add_argument('--instrument', action='store_true', help="add collector points with the query cost of each collector")
+    parser.add_argument('--profile', action='store_true', help="print the query cost of each collector on stderr")
+    parser.add_argument('--explain', default=0, type=int, help="with --profile, EXPLAIN (ANALYZE, BUFFERS) the N slowest statements")
+    parser.add_argument('--itersize', default=10000, type=int, help="rows fetched at a time from a server side cursor")
+    parser.add_argument('--rollups', help="sqlite file of hourly rollups to sum the job, workflow, data growth and upload windows from")
+    parser.add_argument('--approx-users', help="sqlite file of per hour sketches to approximate the distinct user counts from")
+    parser.add_argument('--approx-error', default=0.02, type=float, help="relative standard error of the approximate user counts")
+    parser.add_argument('--changes-only', action='store_true', help="only print the series that changed since the last tick")
+    parser.add_argument('--changes-state', help="with --changes-only, json file that keeps the last printed values between runs")
+    parser.add_argument('--heartbeat', default=10, type=int, help="with --changes-only, print every series at least every N ticks")
+    parser.add_argument('--schedule-state', help="json file that keeps the output of the scheduled collectors between runs")
+    parser.add_argument('--schedule-jitter', default=0.1, type=float, help="fraction of its interval a scheduled collector may run early")
+    parser.add_argument('--instance', help="the instance to poll, of the instances in the config")
+    parser.add_argument('--apply', action='store_true', help="index-check: create the missing indexes with CREATE INDEX CONCURRENTLY")
+
+    commands = ["stats", "daemon", "exporter", "index-check", "tick-config"]
     parser.add_argument('command', nargs='+', help="{}".format(",".join(commands)))
 
     args = parser.parse_args()
@@ -438,18 +1467,80 @@ def main():
         sys.exit()
 
     if command == 'tick-config':
-        print_tick_entry(args.config)
+        interval = "1m"
+        if os.path.isfile(args.config):
+            config = config_utils.readin_config_file(args.config)
+            check_stats_options(parser, args, config, 'daemon' if args.execd else 'stats')
+            interval = tick_interval(config)
+        print_tick_entry(args.config, stats_options(args), args.execd, interval)
         sys.exit()
 
     config = config_utils.readin_config_file(args.config)
+    check_stats_options(parser, args, config, command)
+
+    if "instances" in config and args.instance is None:
+        if command == 'daemon':
+            instances_command(args, config)
+            sys.exit()
+        parser.error("the config has several instances, pick one with --instance")
+    elif args.instance is not None:
+        if args.instance not in config.get('instances', {}):
+            parser.error("there is no instance {} in the config".format(args.instance))
+        config = instances.instance_config(config, args.instance)
+        for option in ['incremental', 'rollups', 'approx_users', 'changes_state', 'schedule_state']:
+            setattr(args, option, instances.instance_path(getattr(args, option), args.instance))
+        sys.stdout = instances.TaggedOutput(sys.stdout, args.instance)
+
+    global STATE_FILE, RECONCILE_INTERVAL, SKETCHES, ROLLUPS, CHANGES, SCHEDULE
+    STATE_FILE = args.incremental
+    RECONCILE_INTERVAL = args.reconcile
+    if args.rollups is not None:
+        ROLLUPS = rollup_store.RollupStore(args.rollups)
+    if args.approx_users is not None:
+        SKETCHES = sketch_store.SketchStore(args.approx_users, hll.precision_for(args.approx_error))
+    # the exporter is scraped, so it always serves every series
+    if args.changes_only and command in ['stats', 'daemon']:
+        CHANGES = change_filter.ChangeFilter(args.changes_state, args.heartbeat)
+    if "schedule" in config and command in ['stats', 'daemon']:
+        SCHEDULE = collector_schedule.Schedule(config['schedule'], args.schedule_state, args.schedule_jitter)
+    if CHANGES is not None or SCHEDULE is not None:
+        sys.stdout = CollectorOutput(sys.stdout)
+
+    global TIMEOUTS, DEFAULT_TIMEOUT, CARDINALITY
+    CARDINALITY = config.get('cardinality', {})
+    TIMEOUTS = {name: float(timeout) for name, timeout in config.get('timeouts', {}).items()}
+    DEFAULT_TIMEOUT = args.collector_timeout
     global DB
+    db_url = None
     if "db_url" in config:
-        DB = db_utils.DB(config.db_url)
+        db_url = config.db_url
     elif "galaxy" in config and "database_connection" in config['galaxy']:
-        DB = db_utils.DB(config['galaxy']['database_connection'])
+        db_url = config['galaxy']['database_connection']
+
+    global PROFILER
+    # index-check takes the statements of the collectors from the profiler
+    if (args.instrument or args.profile or command == 'index-check') and command != 'exporter':
+        PROFILER = profiler.Profiler()
+
+    if db_url is not None and command == 'exporter':
+        # at most one refresh per collector runs at a time
+        DB = pg_pool.PooledDB(db_url, maxconn=len(COLLECTORS), itersize=args.itersize, replica_url=config.get('replica_url'))
+    elif db_url is not None:
+        DB = pg_pool.PooledDB(db_url, maxconn=max(args.parallel, 1), profiler=PROFILER, itersize=args.itersize,
+                              replica_url=config.get('replica_url'))
 
     if command == 'stats':
-        stats_command(args)
+        if stats_command(args):
+            # the interpreter would wait for the thread of the collector that was given up on before exiting
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(0)
+    elif command == 'daemon':
+        daemon_command(args)
+    elif command == 'exporter':
+        exporter_command(args, config)
+    elif command == 'index-check':
+        index_check_command(args)
     elif command == 'tick':
         print_tick_entry()
     else:
@@ -6,39 +6,61 @@
 # Kim Brugger (03 Apr 2019), contact: kim@brugger.dk
 
 import argparse
+import bisect
+import calendar
+import collections
+import concurrent.futures
 import datetime
+import json
 import os
 import re
 import sys
-import requests
+import atexit
+import traceback
 
 import kbr.config_utils as config_utils
-import kbr.db_utils as db_utils
 import kbr.timedate_utils as timedate_utils
 
-points = []
-url    = None
-db     = None
-dbuser = None
-dbpass = None
+import hll
+import event_cache
+import influx_spool
+import instances
+import influx_writer
+import pg_pool
+import profiler
+import rollup_store
+import sketch_store
+
+WRITER = None
+PROFILER = None
+# per hour user sketches, user_stats approximates its counts from them if set
+SKETCHES = None
+# hourly rollups, the metrics that have one are backfilled from it if set
+ROLLUPS = None
+# local columns of the backfilled tables, the metrics are computed from them instead of the database if set
+EVENTS = None
+# the instance of the config that is backfilled, its name is added to the points as a tag
+INSTANCE = None
 
 
 def write_points(data):
 
+    if INSTANCE is not None:
+        data = instances.tag_line(data, INSTANCE)
 
-
-    global url, db, dbuser, dbpass
-    wurl = f"{url}/write?db={db}"
-
-    if url is None:
+    if WRITER is None:
         print( data )
         return
 
-    try:
-        res = requests.post(wurl, data=data, auth=(dbuser, dbpass))
-        res.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        print (e.response.text)
+    WRITER.write(data)
+
+
+class PointList(list):
+
+    """Points of a backfill chunk, collected in a worker process for the main process to write."""
+
+    def write(self, line:str) -> None:
+        self.append(line)
 
 
 
@@ -114,95 +136,313 @@ def make_timeframe(start:str, end:str, interval:str):
     return timeframe, delta_time
 
 
-def workflow_stats(start:str, end:str, interval:str, resolution:str="30s"):
+def steps_cte(start:str, end:str, resolution:str) -> str:
+    ''' the Timerange steps as a "steps(ts, n)" CTE, or None if the range is empty '''
 
-    timeframe, delta_time = make_timeframe(start, end, interval)
+    steps = list(Timerange(start, end, resolution))
+    if steps == []:
+        return None
 
+    step = timedate_utils.timedelta_to_sec( resolution )
+    return f"steps AS (SELECT ts, row_number() OVER (ORDER BY ts) AS n FROM generate_series(timestamp '{steps[0]}', timestamp '{steps[-1]}', INTERVAL '{step} seconds') AS ts)"
 
-    for i in Timerange(start, end, resolution):
-        sql = f"select count(*) AS count  from workflow_invocation WHERE create_time AT TIME ZONE 'UTC' < '{i}' and create_time AT TIME ZONE 'UTC' > timestamp '{i}' - INTERVAL '{delta_time}'"
-        ts = unix_time_nano(i)
-        for entry in DB.get_as_dict(sql):
-            if entry["count"] == None or entry["count"] == 0:
-                continue
-            l = f"workflows,{timeframe} count={entry['count']} {ts}"
-            print(l)
-            write_points(l)
 
+def backfill(table:str, value:str, start:str, end:str, resolution:str, group:str=None, delta_time:str=None):
+    ''' (ts, grp, value) of an aggregate at every step from a single query, streamed off a server side cursor.
 
+    Every row is binned on the first step it is counted at, so the per step values
+    are a running sum over the bins instead of a scan of the table per step. For a
+    window the running sum of the rows that are older than the window start is
+    subtracted again. The window starts are binned on their own as month intervals
+    do not keep them in step order (2020-03-31 and 2020-03-29 are both a month after
+    2020-02-29).
+    '''
 
+    if EVENTS is not None and table in event_cache.TABLES:
+        return cached_backfill(table, value, start, end, resolution, group, delta_time)
 
+    steps = steps_cte(start, end, resolution)
+    if steps is None:
+        return iter([])
+
+    grp = group or "NULL"
+    create_time = "create_time AT TIME ZONE 'UTC'"
+    where = f"{create_time} < (SELECT max(ts) FROM steps)"
+    if delta_time is not None:
+        where += f" AND {create_time} > (SELECT min(ts) FROM cuts)"
+
+    sql  = f"WITH {steps}, "
+    if delta_time is not None:
+        sql += f"cuts AS (SELECT ts, row_number() OVER (ORDER BY ts) AS n FROM (SELECT DISTINCT ts - INTERVAL '{delta_time}' AS ts FROM steps) AS cuts), "
+
+    sql += f"entered AS (SELECT {grp} AS grp, width_bucket({create_time}, (SELECT array_agg(ts::timestamptz ORDER BY n) FROM steps)) + 1 AS n, {value} AS value "
+    sql += f"FROM {table} WHERE {where} GROUP BY 1, 2), "
+
+    if group is None:
+        sql += "groups AS (SELECT NULL AS grp), "
+    else:
+        sql += "groups AS (SELECT DISTINCT grp FROM entered), "
+
+    sql += "totals AS (SELECT steps.ts, steps.n, groups.grp, sum(coalesce(entered.value, 0)) OVER (PARTITION BY groups.grp ORDER BY steps.n) AS value "
+    sql += "FROM steps CROSS JOIN groups LEFT JOIN entered ON entered.n = steps.n AND entered.grp IS NOT DISTINCT FROM groups.grp) "
+
+    if delta_time is None:
+        sql += "SELECT ts, grp, value FROM totals ORDER BY n, grp"
+        return DB.stream(sql)
+
+    # a row has left the window at all the cuts at or after its create_time
+    sql += f", expired AS (SELECT {grp} AS grp, width_bucket({create_time} - INTERVAL '1 microsecond', (SELECT array_agg(ts::timestamptz ORDER BY n) FROM cuts)) + 1 AS n, {value} AS value "
+    sql += f"FROM {table} WHERE {where} GROUP BY 1, 2), "
+    sql += "expired_totals AS (SELECT cuts.ts, groups.grp, sum(coalesce(expired.value, 0)) OVER (PARTITION BY groups.grp ORDER BY cuts.n) AS value "
+    sql += "FROM cuts CROSS JOIN groups LEFT JOIN expired ON expired.n = cuts.n AND expired.grp IS NOT DISTINCT FROM groups.grp) "
+
+    sql += "SELECT totals.ts, totals.grp, totals.value - coalesce(expired_totals.value, 0) AS value FROM totals "
+    sql += f"LEFT JOIN expired_totals ON expired_totals.ts = totals.ts - INTERVAL '{delta_time}' AND expired_totals.grp IS NOT DISTINCT FROM totals.grp "
+    sql += "ORDER BY totals.n, totals.grp"
+
+    return DB.stream(sql)
+
+
+def rollup_backfill(name:str, start:str, end:str, resolution:str, delta_time:str=None):
+    ''' (ts, grp, value) as backfill returns them, summed from the buckets of an hourly rollup. The steps
+    have to be on whole hours. Only the rows added since the last update of the rollups are read. '''
+
+    ROLLUPS.update(DB, name)
+
+    # running sums per group, the value of a window is the difference of two of them
+    hours = collections.defaultdict(list)
+    sums = collections.defaultdict(lambda: [0])
+    for hour, grp, value in ROLLUPS.buckets(name):
+        hours[grp].append(hour)
+        sums[grp].append(sums[grp][-1] + value)
+
+    def running_sum(grp, hour):
+        return sums[grp][bisect.bisect_left(hours[grp], hour)]
+
+    for ts in Timerange(start, end, resolution):
+        for grp in sorted(hours):
+            value = running_sum(grp, epoch_hour(ts))
+            if delta_time is not None:
+                value -= running_sum(grp, epoch_hour(window_start(ts, delta_time)))
+            yield ts, grp or None, value
+
+
+def epoch_microseconds(ts:datetime.datetime) -> int:
+    return calendar.timegm(ts.timetuple()) * 1000000 + ts.microsecond
+
+
+def cached_backfill(table:str, value:str, start:str, end:str, resolution:str, group:str=None, delta_time:str=None):
+    ''' (ts, grp, value) as backfill returns them, from the running totals of the event cache. Like the query,
+    it has the groups that have rows before the last step, and after the first window start '''
+
+    spec = event_cache.TABLES[table]
+    if value != spec['aggregate'] or (group or "NULL") != spec['group']:
+        raise ValueError(f"the event cache has the {spec['aggregate']} of {table} by {spec['group']}, not the {value} by {group}")
+
+    steps = list(Timerange(start, end, resolution))
+    if steps == []:
+        return
+
+    totals = EVENTS.running_totals(table)
+    last = epoch_microseconds(steps[-1])
+    first_cut = None
+    if delta_time is not None:
+        first_cut = min([epoch_microseconds(window_start(ts, delta_time)) for ts in steps])
+
+    groups = []
+    for grp in sorted(totals, key=lambda grp: (grp is None, grp)):
+        times, sums, rows = totals[grp]
+        present = rows[bisect.bisect_left(times, last)]
+        if first_cut is not None:
+            present -= rows[bisect.bisect_right(times, first_cut)]
+        if grp is None or present > 0:
+            groups.append(grp)
+
+    for ts in steps:
+        step = epoch_microseconds(ts)
+        cut = None
+        if delta_time is not None:
+            cut = epoch_microseconds(window_start(ts, delta_time))
+
+        for grp in groups:
+            times, sums, rows = totals[grp]
+            value = sums[bisect.bisect_left(times, step)]
+            # the rows created at or before the window start have left it
+            if cut is not None:
+                value -= sums[bisect.bisect_right(times, cut)]
+            yield ts, grp, value
+
+
+def workflow_backfill(start:str, end:str, resolution:str, delta_time:str=None):
+    if ROLLUPS is not None:
+        return rollup_backfill('workflows', start, end, resolution, delta_time)
+    return backfill("workflow_invocation", "count(*)", start, end, resolution, delta_time=delta_time)
+
+
+def workflow_stats(start:str, end:str, interval:str, resolution:str="30s"):
 
-def data_stats(start:str, end:str, interval, resolution:str="30s"):
     timeframe, delta_time = make_timeframe(start, end, interval)
 
+    for ts, grp, value in workflow_backfill(start, end, resolution, delta_time):
+        if value == 0:
+            continue
+        l = f"workflows,{timeframe} count={value} {unix_time_nano(ts)}"
+        write_points(l)
 
-    for i in Timerange(start, end, resolution):
-        sql = f"SELECT sum(coalesce(dataset.total_size, dataset.file_size, 0)) AS size FROM dataset WHERE create_time AT TIME ZONE 'UTC' < '{i}' and create_time AT TIME ZONE 'UTC' > timestamp '{i}' - INTERVAL '{delta_time}'"
-        ts = unix_time_nano(i)
-        for entry in DB.get_as_dict(sql):
-            if entry["size"] == None or entry["size"] == 0:
-                continue
-            l = f"data_growth,{timeframe} size={entry['size']} {ts}"
-            #print(l)
-            write_points(l)
 
 
+def data_stats(start:str, end:str, interval, resolution:str="30s"):
+    timeframe, delta_time = make_timeframe(start, end, interval)
+
+    for ts, grp, value in backfill("dataset", "sum(coalesce(dataset.total_size, dataset.file_size, 0))", start, end, resolution, delta_time=delta_time):
+        if value == 0:
+            continue
+        l = f"data_growth,{timeframe} size={value} {unix_time_nano(ts)}"
+        write_points(l)
 
 
 
 def job_stats(start:str, end:str, interval, resolution:str="30s"):
     timeframe, delta_time = make_timeframe(start, end, interval)
 
-    for i in Timerange(start, end, resolution):
-        sql = f"SELECT state, count(*) AS count from job WHERE create_time AT TIME ZONE 'UTC' < '{i}' and create_time AT TIME ZONE 'UTC' > timestamp '{i}' - INTERVAL '{delta_time}' group by state"
-        ts = unix_time_nano(i)
-        for entry in DB.get_as_dict(sql):
-            l = f"jobs,{timeframe},state={entry['state']} count={entry['count']} {ts}"
-           #print(l)
-            write_points(l)
+    for ts, grp, value in backfill("job", "count(*)", start, end, resolution, group="state", delta_time=delta_time):
+        if value == 0:
+            continue
+        l = f"jobs,{timeframe},state={grp} count={value} {unix_time_nano(ts)}"
+        write_points(l)
+
+
+
+def window_start(ts:datetime.datetime, delta_time:str) -> datetime.datetime:
+    ''' ts - INTERVAL delta_time as postgresql does it, month steps keep the day of the month if it exists '''
+    size, sort = delta_time.split()
+    size = int(size)
+
+    if sort == "hour":
+        return ts - datetime.timedelta(hours=size)
+    elif sort == "day":
+        return ts - datetime.timedelta(days=size)
 
+    month = ts.year * 12 + ts.month - 1 - size
+    year, month = month // 12, month % 12 + 1
+    return ts.replace(year=year, month=month, day=min(ts.day, calendar.monthrange(year, month)[1]))
 
 
+def sliding_distinct(table:str, key:str, start:str, end:str, resolution:str, delta_time:str):
+    ''' (step, distinct keys created in the window before it) in one ordered pass over the table.
+
+    The rows come from a server side cursor in create_time order. Every key is kept
+    with the time it was last seen, in an ordered dict that is in last seen order as
+    the rows are, so the keys that left the window are at its front. Memory is bounded
+    by the number of keys in the window, not by the rows in it.
+    '''
+
+    steps = Timerange(start, end, resolution)
+    first = next(steps, None)
+    if first is None:
+        return
+
+    # a later month window can start up to 3 days earlier (2023-03-31 and 2023-03-28 are both a month
+    # after 2023-02-28), so keys are only dropped once no later window can hold them
+    slack = datetime.timedelta(0)
+    if delta_time.endswith("month"):
+        slack = datetime.timedelta(days=3)
+
+    after = window_start(first, delta_time) - slack
+    before = timedate_utils.datestr_to_ts(end)
+
+    # the event cache has the times in microseconds, the database as timestamps
+    if EVENTS is not None and event_cache.TABLES.get(table, {}).get('key') == key:
+        rows = EVENTS.keys_between(table, epoch_microseconds(after), epoch_microseconds(before))
+        to_time = epoch_microseconds
+    else:
+        create_time = "create_time AT TIME ZONE 'UTC'"
+        sql  = f"SELECT ({create_time})::timestamp AS ts, {key} FROM {table} "
+        sql += f"WHERE {create_time} > timestamp '{after}' AND {create_time} < timestamp '{before}' "
+        sql += f"ORDER BY {create_time}"
+        rows = DB.stream(sql)
+        to_time = lambda ts: ts
+
+    row = next(rows, None)
+    last_seen = collections.OrderedDict()
+
+    ts = first
+    while ts is not None:
+        step = to_time(ts)
+        while row is not None and row[0] < step:
+            if row[1] is not None:
+                last_seen[row[1]] = row[0]
+                last_seen.move_to_end(row[1])
+            row = next(rows, None)
+
+        cut = window_start(ts, delta_time)
+        dropped = to_time(cut - slack)
+        while last_seen and next(iter(last_seen.values())) <= dropped:
+            last_seen.popitem(last=False)
+
+        cut = to_time(cut)
+        expired = 0
+        for seen in last_seen.values():
+            if seen > cut:
+                break
+            expired += 1
+
+        yield ts, len(last_seen) - expired
+        ts = next(steps, None)
+
+    rows.close()
+
+
+def epoch_hour(ts:datetime.datetime) -> int:
+    return calendar.timegm(ts.timetuple()) // 3600
+
+
+def sketch_distinct(start:str, end:str, resolution:str, delta_time:str):
+    ''' (step, approximate distinct users in the window before it) from the per hour sketches, the steps
+    have to be on whole hours '''
+
+    steps = list(Timerange(start, end, resolution))
+    if steps == []:
+        return
+
+    windows = [(epoch_hour(window_start(ts, delta_time)), epoch_hour(ts) - 1) for ts in steps]
+    SKETCHES.update(DB, min([first for first, last in windows]))
+
+    yield from zip(steps, SKETCHES.sliding(windows))
+
 
 def user_stats(start:str, end:str, interval:str, resolution:str="30s"):
     timeframe, delta_time = make_timeframe(start, end, interval)
 
+    # distinct counts do not add up across bins, so they are counted in a sliding window instead
+    counts = sliding_distinct("job", "user_id", start, end, resolution, delta_time)
+    if SKETCHES is not None:
+        counts = sketch_distinct(start, end, resolution, delta_time)
 
-    for i in Timerange(start, end, resolution):
-        sql = f"select count(distinct(user_id)) as count  from job WHERE create_time AT TIME ZONE 'UTC' < '{i}' and create_time AT TIME ZONE 'UTC' > timestamp '{i}' - INTERVAL '{delta_time}'"
-        ts = unix_time_nano(i)
-        for entry in DB.get_as_dict(sql):
-            if entry["count"] == None or entry["count"] == 0:
-                continue
-            l = f"galaxy-users,{timeframe} count={entry['count']} {ts}"
-            #print(l)
-            write_points(l)
+    for ts, count in counts:
+        if count == 0:
+            continue
+        l = f"galaxy-users,{timeframe} count={count} {unix_time_nano(ts)}"
+        write_points(l)
 
 
 def jobs_total(start:str, end:str, interval:str, resolution:str="30s"):
 
     timeframe = "timeframe=epoch"
 
-    for i in Timerange(start, end, resolution):
-        sql = f"SELECT state, count(*) AS count from job WHERE create_time AT TIME ZONE 'UTC' < '{i}' group by state"
-        ts = unix_time_nano(i)
-        for entry in DB.get_as_dict(sql):
-            if entry["count"] == None or entry["count"] == 0:
-                continue
-            l = f"jobs,{timeframe},state={entry['state']} count={entry['count']} {ts}"
-            write_points(l)
+    for ts, grp, value in backfill("job", "count(*)", start, end, resolution, group="state"):
+        if value == 0:
+            continue
+        l = f"jobs,{timeframe},state={grp} count={value} {unix_time_nano(ts)}"
+        write_points(l)
 
 def datagrowth_total(start:str, end:str, interval:str, resolution:str="30s"):
     timeframe = "timeframe=epoch"
 
-    for i in Timerange(start, end, resolution):
-        sql = f"SELECT sum(coalesce(dataset.total_size, dataset.file_size, 0)) AS size FROM dataset WHERE create_time AT TIME ZONE 'UTC' < '{i}'"
-        ts = unix_time_nano(i)
-        for entry in DB.get_as_dict(sql):
-            if entry["size"] == None or entry["size"] == 0:
-                continue
-            l = f"data_growth,{timeframe} size={entry['size']} {ts}"
+    for ts, grp, value in backfill("dataset", "sum(coalesce(dataset.total_size, dataset.file_size, 0))", start, end, resolution):
+        if value == 0:
+            continue
+        l = f"data_growth,{timeframe} size={value} {unix_time_nano(ts)}"
         write_points(l)
 
 
@@ -210,38 +450,160 @@ def workflow_total(start:str, end:str, interval:str, resolution:str="30s"):
 
     timeframe = "timeframe=epoch"
 
-
-    for i in Timerange(start, end, resolution):
-        sql = f"select count(*) AS count  from workflow_invocation WHERE create_time AT TIME ZONE 'UTC' < '{i}'"
-        ts = unix_time_nano(i)
-        for entry in DB.get_as_dict(sql):
-            if entry["count"] == None or entry["count"] == 0:
-                continue
-            l = f"workflows,{timeframe} count={entry['count']} {ts}"
-            write_points(l)
+    for ts, grp, value in workflow_backfill(start, end, resolution):
+        if value == 0:
+            continue
+        l = f"workflows,{timeframe} count={value} {unix_time_nano(ts)}"
+        write_points(l)
 
 def nels_export_total(start:str, end:str, interval:str, resolution:str="30s"):
 
-
-    for i in Timerange(start, end, resolution):
-        sql = f"SELECT count(*), instance FROM nels_export_tracking  WHERE create_time AT TIME ZONE 'UTC' < '{i}' GROUP BY instance"
-        ts = unix_time_nano(i)
-        for entry in DB.get_as_dict(sql):
-            l = f"nels-exports,instance={entry['instance']} count={entry['count']} {ts}"
-            write_points(l)
+    for ts, grp, value in backfill("nels_export_tracking", "count(*)", start, end, resolution, group="instance"):
+        if value == 0:
+            continue
+        l = f"nels-exports,instance={grp} count={value} {unix_time_nano(ts)}"
+        write_points(l)
 
 def nels_import_total(start:str, end:str, interval:str, resolution:str="30s"):
 
+    for ts, grp, value in backfill("nels_import_tracking", "count(*)", start, end, resolution):
+        l = f"nels-imports count={value} {unix_time_nano(ts)}"
+        write_points(l)
+
+
+
+
+
+# the metrics backfilled by main, in order
+METRICS = {
+    'workflow_stats': workflow_stats,
+    'user_stats': user_stats,
+    'data_stats': data_stats,
+    'job_stats': job_stats,
+    'jobs_total': jobs_total,
+    'datagrowth_total': datagrowth_total,
+    'workflow_total': workflow_total,
+    'nels_export_total': nels_export_total,
+    'nels_import_total': nels_import_total,
+}
 
-    for i in Timerange(start, end, resolution):
-        sql = f"SELECT count(*) FROM nels_import_tracking  WHERE create_time AT TIME ZONE 'UTC' < '{i}'"
-        ts = unix_time_nano(i)
-        for entry in DB.get_as_dict(sql):
-            l = f"nels-imports count={entry['count']} {ts}"
-            write_points(l)
 
+def chunks(start:str, end:str, resolution:str, chunk:str) -> []:
+    ''' the range as (start, end) pairs of whole resolution steps, about chunk long each '''
 
+    per_chunk = max(1, timedate_utils.timedelta_to_sec( chunk ) // timedate_utils.timedelta_to_sec( resolution ))
 
+    starts = [ts for n, ts in enumerate(Timerange(start, end, resolution)) if n % per_chunk == 0]
+    ends = starts[1:] + [timedate_utils.datestr_to_ts(end)]
+
+    return [(str(chunk_start), str(chunk_end)) for chunk_start, chunk_end in zip(starts, ends)]
+
+
+def read_checkpoint(checkpoint_file:str, backfill_range:{}, resume:bool) -> {}:
+    if not resume or not os.path.isfile(checkpoint_file):
+        return dict(backfill_range, done={})
+
+    with open(checkpoint_file) as fh:
+        checkpoint = json.load(fh)
+
+    for key, value in backfill_range.items():
+        if checkpoint.get(key) != value:
+            print(f"checkpoint {checkpoint_file} is for a {key} of {checkpoint.get(key)}, not {value}", file=sys.stderr)
+            sys.exit(1)
+
+    return checkpoint
+
+
+def write_checkpoint(checkpoint_file:str, checkpoint:{}) -> None:
+    tmp_file = f"{checkpoint_file}.tmp"
+    with open(tmp_file, 'w') as fh:
+        json.dump(checkpoint, fh)
+    os.replace(tmp_file, checkpoint_file)
+
+
+def init_worker(db_url:str, itersize:int, approx_users:str, precision:int, rollups:str, events:str) -> None:
+    global DB, SKETCHES, ROLLUPS, INSTANCE, EVENTS
+    if db_url is not None:
+        DB = pg_pool.PooledDB(db_url, maxconn=1, itersize=itersize, timezone='UTC')
+    # the main process updated the cache before the workers started
+    if events is not None:
+        EVENTS = event_cache.EventCache(events)
+    # the points are tagged when the main process writes them
+    INSTANCE = None
+    if approx_users is not None:
+        SKETCHES = sketch_store.SketchStore(approx_users, precision)
+    if rollups is not None:
+        ROLLUPS = rollup_store.RollupStore(rollups)
+
+
+def run_chunk(name:str, start:str, end:str, interval:str, resolution:str) -> []:
+    ''' points of a metric over one chunk, in a worker process '''
+    global WRITER
+    WRITER = PointList()
+    METRICS[name](start, end, interval, resolution)
+    return WRITER
+
+
+def chunked_backfill(db_url:str, args) -> None:
+    ''' runs the metrics per chunk on a process pool. The chunks do not depend on each other, as every
+    backfill query computes its totals from the start of the table. Written chunks are recorded in the
+    checkpoint file, so a --resume run only does the chunks that were not written yet. '''
+
+    backfill_range = {'start': args.start, 'end': args.end, 'interval': args.interval, 'resolution': args.resolution,
+                      'chunk': args.chunk}
+    checkpoint = None
+    if args.checkpoint is not None:
+        checkpoint = read_checkpoint(args.checkpoint, backfill_range, args.resume)
+
+    tasks = []
+    for chunk_start, chunk_end in chunks(args.start, args.end, args.resolution, args.chunk):
+        for name in METRICS:
+            if checkpoint is None or chunk_start not in checkpoint['done'].get(name, []):
+                tasks.append((name, chunk_start, chunk_end))
+
+    failed = spooled = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(db_url, args.itersize, args.approx_users, hll.precision_for(args.approx_error), args.rollups, args.events)) as executor:
+        futures = {executor.submit(run_chunk, name, chunk_start, chunk_end, args.interval, args.resolution): (name, chunk_start)
+                   for name, chunk_start, chunk_end in tasks}
+
+        for future in concurrent.futures.as_completed(futures):
+            name, chunk_start = futures[future]
+            try:
+                points = future.result()
+            except Exception as e:
+                print(f"{name} from {chunk_start} failed:", file=sys.stderr)
+                traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+                failed += 1
+                continue
+
+            for point in points:
+                write_points(point)
+
+            # a chunk only counts as done once its points are out, points that are only in the spool may still be
+            # evicted from it
+            if WRITER is None:
+                sys.stdout.flush()
+            else:
+                dropped, spooled_points = WRITER.dropped, WRITER.spooled
+                WRITER.flush()
+                if WRITER.dropped > dropped:
+                    print(f"{name} from {chunk_start} was not written", file=sys.stderr)
+                    failed += 1
+                    continue
+                if WRITER.spooled > spooled_points:
+                    print(f"{name} from {chunk_start} went to the spool, it is not recorded as done", file=sys.stderr)
+                    spooled += 1
+                    continue
+
+            if checkpoint is not None:
+                checkpoint['done'].setdefault(name, []).append(chunk_start)
+                write_checkpoint(args.checkpoint, checkpoint)
+
+    if spooled > 0:
+        print(f"{spooled} of {len(tasks)} chunks are in the spool, --resume writes them again", file=sys.stderr)
+    if failed > 0:
+        print(f"{failed} of {len(tasks)} chunks failed", file=sys.stderr)
+        sys.exit(1)
 
 
 def main():
@@ -252,41 +614,120 @@ def main():
     parser.add_argument('-i', '--interval', help="time interval", required=True)
     parser.add_argument('-r', '--resolution', default='5m', help="time resolution to pull data for")
 
-    parser.add_argument('-U', '--url', help="time interval")
-    parser.add_argument('-d', '--database', help="time interval")
-    parser.add_argument('-u', '--user', help="time interval")
-    parser.add_argument('-p', '--password', help="time interval")
+    parser.add_argument('-U', '--url', help="influxdb url, points are printed if not given")
+    parser.add_argument('-d', '--database', help="influxdb database")
+    parser.add_argument('-u', '--user', help="influxdb user")
+    parser.add_argument('-p', '--password', help="influxdb password")
+    parser.add_argument('-b', '--batch-size', default=5000, type=int, help="max points per influxdb write")
+    parser.add_argument('-B', '--batch-bytes', default=1024*1024, type=int, help="max bytes per influxdb write")
+    parser.add_argument('--spool', help="directory to keep the points in that influxdb did not take, replayed later")
+    parser.add_argument('--spool-size', default=1024, type=int, help="max MB in the spool, the oldest points are evicted")
+    parser.add_argument('--replay-interval', default=30, type=float, help="seconds between replays of the spool")
+    parser.add_argument('--instrument', action='store_true', help="write collector points with the query cost of each metric")
+    parser.add_argument('--profile', action='store_true', help="print the query cost of each metric on stderr")
+    parser.add_argument('--explain', default=0, type=int, help="with --profile, EXPLAIN (ANALYZE, BUFFERS) the N slowest statements")
+    parser.add_argument('--itersize', default=10000, type=int, help="rows fetched at a time from the database")
+    parser.add_argument('--rollups', help="sqlite file of hourly rollups to backfill the workflow counts from")
+    parser.add_argument('--approx-users', help="sqlite file of per hour sketches to approximate the distinct user counts from")
+    parser.add_argument('--approx-error', default=0.02, type=float, help="relative standard error of the approximate user counts")
+    parser.add_argument('--events', help="directory of a local cache of the rows to backfill from, updated from the database")
+    parser.add_argument('--offline', action='store_true', help="with --events, backfill from the cache as it is, without a database")
+    parser.add_argument('-w', '--workers', default=1, type=int, help="backfill the range in chunks on this many processes")
+    parser.add_argument('--chunk', default='30d', help="time range of a chunk")
+    parser.add_argument('-C', '--checkpoint', help="file the finished chunks are recorded in")
+    parser.add_argument('--instance', help="the instance to backfill, of the instances in the config")
+    parser.add_argument('--resume', action='store_true', help="skip the chunks that are done according to the checkpoint file")
 
     args = parser.parse_args()
+
+    chunked = args.workers > 1 or args.checkpoint is not None
+    if args.resume and args.checkpoint is None:
+        parser.error("--resume requires a --checkpoint file")
+    if chunked and (args.instrument or args.profile):
+        parser.error("--instrument and --profile are not available for a chunked backfill")
+    # the sketches and rollups are per hour, so the windows have to start and end on whole hours
+    if (args.approx_users is not None or args.rollups is not None) and (
+            timedate_utils.timedelta_to_sec(args.resolution) % 3600 != 0 or
+            calendar.timegm(timedate_utils.datestr_to_ts(args.start).timetuple()) % 3600 != 0):
+        parser.error("--approx-users and --rollups require a start and resolution of whole hours")
+    if args.events is not None and (args.approx_users is not None or args.rollups is not None):
+        parser.error("--events replaces --approx-users and --rollups")
+    if args.offline and args.events is None:
+        parser.error("--offline requires an --events cache")
 #    workflow_stats(args.start, args.end, args.interval)
 
 #    sys.exit()
 
-    global url, db, dbuser, dbpass
-    url    = args.url
-    db     = args.database
-    dbuser = args.user
-    dbpass = args.password
+    global WRITER
+    if args.url is not None:
+        spool = None
+        if args.spool is not None:
+            spool = influx_spool.Spool(args.spool, max_bytes=args.spool_size * 1024 * 1024)
+        WRITER = influx_writer.InfluxWriter(args.url, args.database, args.user, args.password,
+                                            batch_lines=args.batch_size, batch_bytes=args.batch_bytes,
+                                            spool=spool, replay_interval=args.replay_interval)
+        atexit.register(WRITER.close)
 
 
 
     config = config_utils.readin_config_file(args.config)
-    global DB
+    global DB, PROFILER, SKETCHES, ROLLUPS, INSTANCE, EVENTS
+    if "instances" in config:
+        if args.instance not in config['instances']:
+            parser.error("the config has several instances, pick one with --instance")
+        config = instances.instance_config(config, args.instance)
+        for option in ['rollups', 'approx_users', 'checkpoint', 'events']:
+            setattr(args, option, instances.instance_path(getattr(args, option), args.instance))
+        INSTANCE = args.instance
+    elif args.instance is not None:
+        parser.error("--instance needs a config with instances")
+
+    db_url = None
     if "db_url" in config:
-        DB = db_utils.DB(config.db_url)
+        db_url = config.db_url
     elif "galaxy" in config and "database_connection" in config['galaxy']:
-        DB = db_utils.DB(config['galaxy']['database_connection'])
-
-#    workflow_stats(args.start, args.end, args.interval, args.resolution)
-#    user_stats(args.start, args.end, args.interval, args.resolution)
-#    data_stats(args.start, args.end, args.interval, args.resolution)
-#    job_stats(args.start, args.end, args.interval, args.resolution)
-
-    jobs_total(args.start, args.end, args.interval, args.resolution)
-    datagrowth_total(args.start, args.end, args.interval, args.resolution)
-    workflow_total(args.start, args.end, args.interval, args.resolution)
-    nels_export_total(args.start, args.end, args.interval, args.resolution)
-    nels_import_total(args.start, args.end, args.interval, args.resolution)
+        db_url = config['galaxy']['database_connection']
+
+    if args.events is not None:
+        EVENTS = event_cache.EventCache(args.events)
+    if args.offline:
+        db_url = None
+    elif EVENTS is not None:
+        cache_db = pg_pool.PooledDB(db_url, maxconn=1, itersize=args.itersize, timezone='UTC')
+        EVENTS.update(cache_db)
+        cache_db.close()
+
+    if chunked:
+        chunked_backfill(db_url, args)
+        return
+
+    if args.approx_users is not None:
+        SKETCHES = sketch_store.SketchStore(args.approx_users, hll.precision_for(args.approx_error))
+    if args.rollups is not None:
+        ROLLUPS = rollup_store.RollupStore(args.rollups)
+
+    if args.instrument or args.profile:
+        PROFILER = profiler.Profiler()
+
+    # a pooled connection, as the sliding windows stream their rows from a server side cursor. The steps are in
+    # UTC, as the create_times are, so the timestamps of the queries are compared in UTC too
+    if db_url is not None:
+        DB = pg_pool.PooledDB(db_url, maxconn=1, profiler=PROFILER, itersize=args.itersize, timezone='UTC')
+
+    for name, metric in METRICS.items():
+        if PROFILER is not None:
+            PROFILER.run(name, metric, args.start, args.end, args.interval, args.resolution)
+        else:
+            metric(args.start, args.end, args.interval, args.resolution)
+
+    if PROFILER is not None:
+        if args.instrument:
+            for point in PROFILER.points():
+                write_points(point)
+        if args.profile:
+            PROFILER.report()
+            if args.explain > 0:
+                PROFILER.explain(DB, args.explain)
 
 if __name__ == "__main__":
     main()
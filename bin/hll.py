@@ -0,0 +1,85 @@
+#
+# HyperLogLog sketches for approximate distinct counts
+#
+
+import hashlib
+import math
+import struct
+
+INVERSE_POWERS = [2.0 ** -r for r in range(65)]
+
+
+def precision_for(error:float) -> int:
+    ''' number of index bits for a relative standard error, 1.04 / sqrt(2^p) <= error '''
+    return max(4, min(16, math.ceil(math.log2((1.04 / error) ** 2))))
+
+
+class HyperLogLog:
+
+    """Mergeable distinct count sketch with 2^precision one byte registers."""
+
+    def __init__(self, precision:int=12, registers:bytearray=None):
+        self.precision = precision
+        self.registers = registers if registers is not None else bytearray(1 << precision)
+        # the (index, rank) pairs of a sketch read in sparse, merged in without a pass over all registers
+        self._pairs = None
+
+    def add(self, value) -> None:
+        h = int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(), 'big')
+        bits = 64 - self.precision
+        index = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            self._pairs = None
+
+    def merge(self, other:'HyperLogLog') -> 'HyperLogLog':
+        self._pairs = None
+        if other._pairs is None:
+            self.registers = bytearray(map(max, self.registers, other.registers))
+            return self
+
+        registers = self.registers
+        for index, rank in other._pairs:
+            if rank > registers[index]:
+                registers[index] = rank
+        return self
+
+    def copy(self) -> 'HyperLogLog':
+        return HyperLogLog(self.precision, bytearray(self.registers))
+
+    def count(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        if m == 16:
+            alpha = 0.673
+        elif m == 32:
+            alpha = 0.697
+        elif m == 64:
+            alpha = 0.709
+
+        estimate = alpha * m * m / sum(map(INVERSE_POWERS.__getitem__, self.registers))
+        zeros = self.registers.count(0)
+        # linear counting is more precise while many registers are still empty
+        if estimate <= 2.5 * m and zeros > 0:
+            estimate = m * math.log(m / zeros)
+
+        return int(round(estimate))
+
+    def to_bytes(self) -> bytes:
+        ''' sparse (index, rank) pairs while they take less room than the registers '''
+        used = [(index, rank) for index, rank in enumerate(self.registers) if rank > 0]
+        if len(used) * 3 < len(self.registers):
+            return b'S' + b''.join([struct.pack('>HB', index, rank) for index, rank in used])
+        return b'D' + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, precision:int, data:bytes) -> 'HyperLogLog':
+        if data[:1] == b'D':
+            return cls(precision, bytearray(data[1:]))
+
+        sketch = cls(precision)
+        sketch._pairs = list(struct.iter_unpack('>HB', data[1:]))
+        for index, rank in sketch._pairs:
+            sketch.registers[index] = rank
+        return sketch
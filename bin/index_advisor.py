@@ -0,0 +1,80 @@
+#
+# Sequential scans in the plans of the collector statements and the indexes that avoid them
+#
+
+# The rolling windows filter on create_time AT TIME ZONE 'UTC', which a plain
+# create_time index can not serve, so those indexes are on the expression itself.
+RECOMMENDED = [
+    {'name': 'ix_job_queue_tool_id_state', 'table': 'job',
+     'definition': "(tool_id, state) WHERE state IN ('queued', 'running')",
+     'collectors': ['queue', 'queue-latency', 'snapshot']},
+    {'name': 'ix_job_create_time_utc_user_id', 'table': 'job',
+     'definition': "((create_time AT TIME ZONE 'UTC'), user_id)",
+     'collectors': ['users-rolling', 'snapshot']},
+    {'name': 'ix_job_upload_create_time', 'table': 'job',
+     'definition': "(create_time) WHERE tool_id = 'upload1'",
+     'collectors': ['data', 'snapshot']},
+    {'name': 'ix_job_update_time', 'table': 'job', 'column': 'update_time',
+     'definition': "(update_time)",
+     'collectors': ['jobs', 'snapshot']},
+    {'name': 'ix_dataset_update_time', 'table': 'dataset', 'column': 'update_time',
+     'definition': "(update_time)",
+     'collectors': ['growth', 'snapshot']},
+    {'name': 'ix_workflow_invocation_create_time_utc', 'table': 'workflow_invocation',
+     'definition': "((create_time AT TIME ZONE 'UTC'))",
+     'collectors': ['workflows-rolling', 'snapshot']},
+]
+
+
+def existing_indexes(db, tables:list) -> {}:
+    ''' index name -> table, leading column (None for expressions), partial and valid '''
+    sql = "SELECT i.relname AS name, t.relname AS table, a.attname AS column, x.indpred IS NOT NULL AS partial, "
+    sql += "x.indisvalid AS valid FROM pg_index x "
+    sql += "JOIN pg_class i ON i.oid = x.indexrelid JOIN pg_class t ON t.oid = x.indrelid "
+    sql += "LEFT JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = x.indkey[0] "
+    sql += "WHERE t.relname IN ({}) AND pg_table_is_visible(t.oid)".format(", ".join(["'{}'".format(t) for t in tables]))
+
+    return {entry['name']: entry for entry in db.get_as_dict(sql)}
+
+
+def covering_index(index:{}, indexes:{}) -> str:
+    ''' name of an existing index that serves the recommended one '''
+    if index['name'] in indexes:
+        return index['name']
+
+    # plain column indexes may exist under another name, eg from galaxy's own migrations
+    if 'column' in index:
+        for name, entry in indexes.items():
+            if entry['table'] == index['table'] and entry['column'] == index['column'] and not entry['partial'] and entry['valid']:
+                return name
+
+    return None
+
+
+def plan_nodes(plan:{}):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+def seq_scans(db, sql:str) -> []:
+    ''' the sequential scans in the estimated plan of a statement '''
+    plan = db.get_as_dict("EXPLAIN (FORMAT JSON) {}".format(sql))[0]['QUERY PLAN'][0]['Plan']
+
+    res = []
+    for node in plan_nodes(plan):
+        if node['Node Type'] == 'Seq Scan':
+            res.append({'table': node['Relation Name'], 'rows': node['Plan Rows'], 'filter': node.get('Filter')})
+
+    return res
+
+
+def table_rows(db, tables:list) -> {}:
+    sql = "SELECT relname, reltuples::bigint AS rows FROM pg_class WHERE relkind = 'r' AND relname IN ({}) "
+    sql += "AND pg_table_is_visible(oid)"
+    entries = db.get_as_dict(sql.format(", ".join(["'{}'".format(t) for t in tables])))
+    return {entry['relname']: entry['rows'] for entry in entries}
+
+
+def ddl(index:{}, concurrently:bool=True) -> str:
+    return "CREATE INDEX {}{} ON {} {};".format("CONCURRENTLY " if concurrently else "", index['name'], index['table'], index['definition'])
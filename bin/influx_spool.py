@@ -0,0 +1,98 @@
+#
+# Durable local spool for line protocol that could not be written to influxdb
+#
+
+import os
+import re
+import sys
+import threading
+
+
+class Spool:
+
+    """Append only segment files of line protocol, fsync'ed per batch and read back oldest first.
+
+    Once the segments take up more than max_bytes the oldest ones are evicted.
+    """
+
+    def __init__(self, directory:str, max_bytes:int=1024*1024*1024, segment_bytes:int=16*1024*1024):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._segment_bytes = segment_bytes
+        self._lock = threading.Lock()
+        self._current = None
+
+        os.makedirs(directory, exist_ok=True)
+
+    def _segments(self) -> []:
+        names = [name for name in os.listdir(self._directory) if re.match(r'^segment-\d+\.lp$', name)]
+        return [os.path.join(self._directory, name) for name in sorted(names)]
+
+    def _rotate(self) -> None:
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+
+        segments = self._segments()
+        seq = 0
+        if segments != []:
+            seq = int(re.search(r'(\d+)\.lp$', segments[-1]).group(1)) + 1
+
+        self._current = open(os.path.join(self._directory, "segment-{:012d}.lp".format(seq)), 'a')
+
+    def _evict(self) -> int:
+        evicted = 0
+        segments = self._segments()
+        size = sum([os.path.getsize(segment) for segment in segments])
+
+        # the segment that is written to stays
+        while size > self._max_bytes and len(segments) > 1:
+            segment = segments.pop(0)
+            size -= os.path.getsize(segment)
+            with open(segment) as fh:
+                lines = sum(1 for _ in fh)
+            os.remove(segment)
+            evicted += lines
+            print("spool is over {} bytes, evicted {} points".format(self._max_bytes, lines), file=sys.stderr)
+
+        return evicted
+
+    def pending(self) -> bool:
+        with self._lock:
+            return self._segments() != []
+
+    def append(self, lines:[]) -> int:
+        ''' spools the lines, returns the number of points evicted to make room for them '''
+        with self._lock:
+            if self._current is None or self._current.tell() >= self._segment_bytes:
+                self._rotate()
+
+            self._current.write("\n".join(lines) + "\n")
+            self._current.flush()
+            os.fsync(self._current.fileno())
+            return self._evict()
+
+    def oldest(self) -> (str, []):
+        ''' path and lines of the oldest segment, or None if the spool is empty '''
+        with self._lock:
+            segments = self._segments()
+            if segments == []:
+                return None
+
+            # the segment being written to is closed before it is read
+            if self._current is not None and os.path.samefile(self._current.name, segments[0]):
+                self._current.close()
+                self._current = None
+
+            with open(segments[0]) as fh:
+                return segments[0], fh.read().splitlines()
+
+    def remove(self, segment:str) -> None:
+        with self._lock:
+            os.remove(segment)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._current is not None:
+                self._current.close()
+                self._current = None
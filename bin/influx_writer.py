@@ -0,0 +1,196 @@
+#
+# Buffered writer for the influxdb /write endpoint
+#
+
+import gzip
+import queue
+import sys
+import threading
+import time
+
+import requests
+
+
+class InfluxWriter:
+
+    """Collects line protocol points and writes them in gzipped batches over one keep-alive session.
+
+    The batches are posted from a sender thread, so the caller keeps reading from the
+    database while a batch is on its way. At most pending batches wait for the sender
+    before write blocks.
+
+    With a spool (influx_spool.Spool) a batch that can not be written after one retry
+    goes to the spool instead of being dropped. While the spool holds points, new
+    batches are spooled behind them, and the sender replays the spool every
+    replay_interval seconds until influxdb takes writes again.
+    """
+
+    def __init__(self, url:str, db:str, user:str=None, password:str=None, batch_lines:int=5000,
+                 batch_bytes:int=1024*1024, retries:int=5, backoff:float=1.0, timeout:float=30, pending:int=16,
+                 spool=None, replay_interval:float=30):
+        self._url = f"{url}/write"
+        self._params = {'db': db}
+        self._batch_lines = batch_lines
+        self._batch_bytes = batch_bytes
+        self._retries = retries
+        self._backoff = backoff
+        self._timeout = timeout
+
+        self._session = requests.Session()
+        self._session.headers.update({'Content-Encoding': 'gzip', 'Content-Type': 'text/plain; charset=utf-8'})
+        if user is not None:
+            self._session.auth = (user, password)
+
+        self._spool = spool
+        self._replay_interval = replay_interval
+        self._replayed = 0
+
+        self._lines = []
+        self._size = 0
+        self._batches = queue.Queue(maxsize=pending)
+        self._sender = threading.Thread(target=self._send, daemon=True)
+        self._sender.start()
+
+        self.points = 0
+        self.bytes = 0
+        self.requests = 0
+        self.dropped = 0
+        self.spooled = 0
+        # spooled points that are lost, evicted to make room or rejected when replayed
+        self.evicted = 0
+        self.replayed = 0
+
+    def write(self, line:str) -> None:
+        self._lines.append(line)
+        self._size += len(line) + 1
+
+        if len(self._lines) >= self._batch_lines or self._size >= self._batch_bytes:
+            self._queue_batch()
+
+    def _queue_batch(self) -> None:
+        if self._lines == []:
+            return
+
+        self._batches.put(self._lines)
+        self._lines = []
+        self._size = 0
+
+    def flush(self) -> None:
+        ''' returns once all points written so far are posted '''
+        self._queue_batch()
+        self._batches.join()
+
+    def _send(self) -> None:
+        timeout = None
+        if self._spool is not None:
+            timeout = self._replay_interval
+
+        while True:
+            try:
+                lines = self._batches.get(timeout=timeout)
+            except queue.Empty:
+                self._replay_safely()
+                continue
+
+            if lines is None:
+                if self._spool is not None:
+                    self._replay_safely()
+                self._batches.task_done()
+                return
+
+            try:
+                self._write_batch(lines)
+            except Exception as e:
+                # the sender has to live on, or flush and write would wait for it forever
+                print(f"influx write of {len(lines)} points failed: {e!r}", file=sys.stderr)
+                self.dropped += len(lines)
+            finally:
+                self._batches.task_done()
+
+    def _replay_safely(self) -> None:
+        try:
+            self._replay()
+        except Exception as e:
+            print(f"replaying the spool failed: {e!r}", file=sys.stderr)
+
+    def _write_batch(self, lines:[]) -> None:
+        if self._spool is not None and self._spool.pending():
+            if time.time() - self._replayed >= self._replay_interval:
+                self._replay()
+            # influxdb is still down, keep pulling data at full speed
+            if self._spool.pending():
+                self.evicted += self._spool.append(lines)
+                self.spooled += len(lines)
+                return
+
+        retries = self._retries
+        if self._spool is not None:
+            retries = min(retries, 1)
+
+        body = gzip.compress("\n".join(lines).encode('utf-8'))
+        status = self._post(body, retries)
+        if status == 'written':
+            self.points += len(lines)
+            self.bytes += len(body)
+        elif status == 'failed' and self._spool is not None:
+            self.evicted += self._spool.append(lines)
+            self.spooled += len(lines)
+        else:
+            self.dropped += len(lines)
+
+    def _replay(self) -> None:
+        ''' writes the spooled segments oldest first, up to the first one that fails '''
+        self._replayed = time.time()
+
+        while True:
+            segment = self._spool.oldest()
+            if segment is None:
+                return
+
+            path, lines = segment
+            for start in range(0, len(lines), self._batch_lines):
+                body = gzip.compress("\n".join(lines[start:start + self._batch_lines]).encode('utf-8'))
+                status = self._post(body, 0)
+                if status == 'failed':
+                    return
+                if status == 'rejected':
+                    self.evicted += len(lines[start:start + self._batch_lines])
+                else:
+                    self.replayed += len(lines[start:start + self._batch_lines])
+                    self.bytes += len(body)
+
+            self._spool.remove(path)
+
+    def _post(self, body:bytes, retries:int) -> str:
+        ''' written, rejected (a 4xx, retrying would not help) or failed '''
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                time.sleep(self._backoff * 2 ** (attempt - 1))
+
+            try:
+                self.requests += 1
+                res = self._session.post(self._url, params=self._params, data=body, timeout=self._timeout)
+                if res.status_code < 500:
+                    res.raise_for_status()
+                    return 'written'
+                error = f"{res.status_code} {res.text}"
+            except requests.exceptions.HTTPError as e:
+                print(e.response.text, file=sys.stderr)
+                return 'rejected'
+            except requests.exceptions.RequestException as e:
+                error = str(e)
+
+            print(f"influx write failed ({error}), attempt {attempt + 1} of {retries + 1}", file=sys.stderr)
+
+        return 'failed'
+
+    def close(self) -> None:
+        self.flush()
+        self._batches.put(None)
+        self._sender.join()
+        self._session.close()
+
+        if self._spool is not None:
+            self._spool.close()
+            print(f"spooled {self.spooled} points, replayed {self.replayed} spooled points, lost {self.evicted} spooled points", file=sys.stderr)
+        print(f"wrote {self.points} points ({self.bytes} bytes gzipped) in {self.requests} requests, dropped {self.dropped}", file=sys.stderr)
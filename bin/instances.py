@@ -0,0 +1,124 @@
+#
+# Several named Galaxy instances in one config, polled by a daemon process per instance
+#
+
+import os
+import re
+import subprocess
+import sys
+import threading
+
+# the lines of the instance processes are written whole
+OUTPUT_LOCK = threading.Lock()
+
+
+def names(config) -> list:
+    return list(config.get('instances', {}).keys())
+
+
+def instance_config(config, name:str):
+    ''' the config of a named instance, its own entries over the shared ones. The entries of a section, eg
+    timeouts, are merged with the shared ones of the section '''
+    merged = type(config)(config)
+    del merged['instances']
+    for key, value in config['instances'][name].items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            value = {**merged[key], **value}
+        merged[key] = value
+    return merged
+
+
+def instance_path(path:str, name:str) -> str:
+    ''' a local state file of an instance, "rollups.db" -> "rollups.<name>.db" '''
+    if path is None:
+        return None
+    root, ext = os.path.splitext(path.rstrip(os.sep))
+    return "{}.{}{}".format(root, re.sub(r'[^\w.-]', '_', name), ext)
+
+
+def tag_line(line:str, name:str) -> str:
+    ''' adds the instance tag to a line, a tag of the line that is called instance already becomes nels_instance '''
+    if line.strip() == "":
+        return line
+
+    measurement, tags, rest = re.match(r'([^,\s]+)((?:,\S*)?)(.*)$', line, re.S).groups()
+    tags = tags.replace(",instance=", ",nels_instance=")
+    return "{},instance={}{}{}".format(measurement, re.sub(r'([ ,=])', r'\\\1', name), tags, rest)
+
+
+class TaggedOutput:
+
+    """sys.stdout stand-in that adds the instance tag to every line written to it."""
+
+    def __init__(self, stdout, name:str):
+        self._stdout = stdout
+        self._name = name
+        self._partial = ""
+        self._lock = threading.Lock()
+
+    def write(self, s:str) -> int:
+        with self._lock:
+            lines = (self._partial + s).split("\n")
+            self._partial = lines.pop()
+            for line in lines:
+                self._stdout.write(tag_line(line, self._name) + "\n")
+        return len(s)
+
+    def __getattr__(self, name):
+        return getattr(self._stdout, name)
+
+
+class InstanceDaemon:
+
+    """The daemon of one instance, ticked through its stdin.
+
+    It prints an empty line at the end of every tick. A tick is only passed on once the
+    previous one is done, so a slow or unreachable instance does not hold up the others
+    and does not pile up ticks. A daemon that died is started again on the next tick.
+    """
+
+    def __init__(self, name:str, command:list):
+        self.name = name
+        self.command = command
+        self._process = None
+        self._busy = False
+
+    def _start(self) -> None:
+        self._process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1)
+        self._busy = False
+        threading.Thread(target=self._relay, args=(self._process.stdout,), daemon=True).start()
+
+    def _relay(self, stream) -> None:
+        lines = []
+        for line in stream:
+            if line.strip() != "":
+                lines.append(line)
+                continue
+
+            with OUTPUT_LOCK:
+                sys.stdout.write("".join(lines))
+                sys.stdout.flush()
+            lines = []
+            self._busy = False
+
+    def tick(self) -> None:
+        if self._process is not None and self._process.poll() is not None:
+            print("instance {} exited with code {}, starting it again".format(self.name, self._process.returncode), file=sys.stderr)
+            self._process = None
+        if self._process is None:
+            self._start()
+
+        if self._busy:
+            print("instance {} is still busy with its previous tick, skipping this one".format(self.name), file=sys.stderr)
+            return
+
+        try:
+            self._busy = True
+            self._process.stdin.write("\n")
+            self._process.stdin.flush()
+        except OSError:
+            self._busy = False
+
+    def stop(self) -> None:
+        if self._process is not None and self._process.poll() is None:
+            self._process.terminate()
@@ -0,0 +1,143 @@
+#
+# Thread safe postgresql connection pool with the query interface of kbr.db_utils.DB
+#
+
+import contextlib
+import re
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+
+# raised when a statement runs into the deadline of its time budget
+QueryCanceled = psycopg2.extensions.QueryCanceledError
+
+
+def dsn(url:str) -> str:
+    ''' libpq connection uri from a sqlalchemy style url (postgresql+psycopg2://...) '''
+    return re.sub(r'^postgres(ql)?(\+\w+)?://', 'postgresql://', url)
+
+
+class PooledDB:
+
+    """Drop in for kbr.db_utils.DB that runs every query on its own connection from a pool.
+
+    The queries of a thread can be sent to a read replica and given a deadline, see set_context. Every
+    statement gets the time that is left until the deadline as its statement_timeout, so a collector
+    of several statements stays within its budget too.
+    """
+
+    def __init__(self, url:str, maxconn:int=4, profiler=None, itersize:int=10000, replica_url:str=None,
+                 timezone:str=None):
+        self._profiler = profiler
+        self._itersize = itersize
+        self._timezone = timezone
+        self._local = threading.local()
+
+        self._pool = psycopg2.pool.ThreadedConnectionPool(1, maxconn, dsn(url))
+        self._replica_pool = None
+        self.has_replica = replica_url is not None
+        if replica_url is not None:
+            self._replica_pool = psycopg2.pool.ThreadedConnectionPool(1, maxconn, dsn(replica_url))
+
+    def set_context(self, replica:bool=False, deadline:float=None) -> None:
+        ''' sends the queries of this thread to the replica (if there is one), and cancels them server side
+        at the deadline (a time.time() value) '''
+        self._local.replica = replica
+        self._local.deadline = deadline
+
+    @contextlib.contextmanager
+    def primary(self):
+        ''' runs the queries of the with block on the primary '''
+        replica = getattr(self._local, 'replica', False)
+        self._local.replica = False
+        try:
+            yield
+        finally:
+            self._local.replica = replica
+
+    def _pool_for_thread(self):
+        if getattr(self._local, 'replica', False) and self._replica_pool is not None:
+            return self._replica_pool
+        return self._pool
+
+    def _getconn(self, pool):
+        ''' a connection of the pool, in the session time zone of the pool if it has one '''
+        conn = pool.getconn()
+        if self._timezone is not None and conn.info.parameter_status('TimeZone') != self._timezone:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute("SET TIME ZONE %s", (self._timezone,))
+        return conn
+
+    def _set_timeout(self, cursor, local:bool=False) -> bool:
+        deadline = getattr(self._local, 'deadline', None)
+        if deadline is None:
+            return False
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise QueryCanceled("canceling statement, the time budget is used up")
+
+        cursor.execute("SET {}statement_timeout = {}".format("LOCAL " if local else "", max(1, int(remaining * 1000))))
+        return True
+
+    def get_as_dict(self, sql:str) -> []:
+        pool = self._pool_for_thread()
+        conn = self._getconn(pool)
+        timed = False
+        try:
+            conn.autocommit = True
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                timed = self._set_timeout(cursor)
+                start = time.time()
+                cursor.execute(sql)
+                executed = time.time()
+                rows = []
+                if cursor.description is not None:
+                    rows = [dict(row) for row in cursor.fetchall()]
+
+                if self._profiler is not None:
+                    self._profiler.record(sql, executed - start, time.time() - executed, len(rows))
+                return rows
+        finally:
+            if timed and not conn.closed:
+                with conn.cursor() as cursor:
+                    cursor.execute("RESET statement_timeout")
+            pool.putconn(conn, close=bool(conn.closed))
+
+    def stream(self, sql:str, itersize:int=None):
+        ''' rows as tuples from a server side cursor, fetched itersize rows at a time '''
+        pool = self._pool_for_thread()
+        conn = self._getconn(pool)
+        try:
+            # named cursors only live inside a transaction, which also ends a SET LOCAL
+            conn.autocommit = False
+            with conn.cursor() as cursor:
+                self._set_timeout(cursor, local=True)
+            with conn.cursor(name="stream") as cursor:
+                cursor.itersize = itersize or self._itersize
+                start = time.time()
+                cursor.execute(sql)
+                executed = time.time()
+                rows = 0
+                try:
+                    for row in cursor:
+                        rows += 1
+                        yield row
+                finally:
+                    # also for a stream the caller stopped reading early
+                    if self._profiler is not None:
+                        self._profiler.record(sql, executed - start, time.time() - executed, rows)
+        finally:
+            if not conn.closed:
+                conn.rollback()
+            pool.putconn(conn, close=bool(conn.closed))
+
+    def close(self) -> None:
+        self._pool.closeall()
+        if self._replica_pool is not None:
+            self._replica_pool.closeall()
@@ -0,0 +1,86 @@
+#
+# Query cost of the collectors, as collector points and a profile table
+#
+
+import sys
+import threading
+import time
+
+
+class Profiler:
+
+    """Records the statements run by each collector, attributed to the collector running in the current thread."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        self.started = time.time()
+        self.statements = []
+        self.collectors = {}
+
+    def start(self, name:str) -> None:
+        self._local.collector = name
+        self._local.started = time.time()
+
+    def stop(self) -> None:
+        name = self._local.collector
+        with self._lock:
+            stats = self._collector_stats(name)
+            stats['duration'] += time.time() - self._local.started
+        self._local.collector = None
+
+    def run(self, name:str, func, *args):
+        self.start(name)
+        try:
+            return func(*args)
+        finally:
+            self.stop()
+
+    def record(self, sql:str, execute:float, fetch:float, rows:int) -> None:
+        ''' called by pg_pool.PooledDB for every statement '''
+        name = getattr(self._local, 'collector', None)
+        if name is None:
+            return
+
+        with self._lock:
+            self.statements.append({'collector': name, 'sql': sql, 'execute': execute, 'fetch': fetch, 'rows': rows})
+            stats = self._collector_stats(name)
+            stats['statements'] += 1
+            stats['execute'] += execute
+            stats['fetch'] += fetch
+            stats['rows'] += rows
+
+    def _collector_stats(self, name:str) -> {}:
+        if name not in self.collectors:
+            self.collectors[name] = {'statements': 0, 'execute': 0.0, 'fetch': 0.0, 'rows': 0, 'duration': 0.0}
+        return self.collectors[name]
+
+    def points(self) -> []:
+        ''' collector points, prefixed galaxy_ by telegraf like the other measurements '''
+        res = []
+        for name, stats in self.collectors.items():
+            res.append("collector,collector={} sql_time={:.6f},fetch_time={:.6f},rows={},statements={},duration={:.6f}".format(
+                name, stats['execute'], stats['fetch'], stats['rows'], stats['statements'], stats['duration']))
+
+        res.append("collector,collector=tick duration={:.6f}".format(time.time() - self.started))
+        return res
+
+    def report(self, file=sys.stderr) -> None:
+        print("{:<20} {:>10} {:>10} {:>10} {:>10} {:>10}".format('collector', 'statements', 'sql_time', 'fetch_time', 'rows', 'duration'), file=file)
+        for name, stats in sorted(self.collectors.items(), key=lambda item: item[1]['duration'], reverse=True):
+            print("{:<20} {:>10} {:>10.3f} {:>10.3f} {:>10} {:>10.3f}".format(
+                name, stats['statements'], stats['execute'], stats['fetch'], stats['rows'], stats['duration']), file=file)
+        print("{:<20} {:>10} {:>10} {:>10} {:>10} {:>10.3f}".format('tick', '', '', '', '', time.time() - self.started), file=file)
+
+    def slowest(self, count:int) -> []:
+        return sorted(self.statements, key=lambda statement: statement['execute'] + statement['fetch'], reverse=True)[:count]
+
+    def explain(self, db, count:int, file=sys.stderr) -> None:
+        ''' EXPLAIN (ANALYZE, BUFFERS) of the count slowest statements, this runs them again '''
+        for statement in self.slowest(count):
+            print("\n-- {} {:.3f}s: {}".format(statement['collector'], statement['execute'] + statement['fetch'], statement['sql']), file=file)
+            for entry in db.get_as_dict("EXPLAIN (ANALYZE, BUFFERS) {}".format(statement['sql'])):
+                print(entry['QUERY PLAN'], file=file)
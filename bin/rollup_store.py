@@ -0,0 +1,210 @@
+#
+# Hourly rollups of the windowed job, workflow, dataset and upload metrics, kept in a local sqlite file
+#
+
+import sqlite3
+import threading
+import time
+import zlib
+
+FINISHED_JOB_STATES = "'ok', 'error', 'deleted', 'deleted_new', 'failed', 'stopped', 'skipped'"
+
+# table, the row id, the time column the windows are on (utc if it is compared AT TIME ZONE 'UTC', as
+# the create_time windows are), the group and the value of a row, and how rows are picked up:
+#   tracked   rows whose time moved past the watermark, the time is an update_time
+#   settled   rows after the id watermark, and the rows that were not finished yet on the previous update
+ROLLUPS = {
+    'jobs': {'table': 'job', 'id': "id", 'time': "update_time", 'utc': False, 'group': "state", 'value': "1",
+             'mode': 'tracked'},
+    'growth': {'table': 'dataset', 'id': "id", 'time': "update_time", 'utc': False, 'group': "NULL",
+               'value': "coalesce(total_size, file_size, 0)", 'mode': 'tracked'},
+    'workflows': {'table': 'workflow_invocation', 'id': "id", 'time': "create_time", 'utc': True, 'group': "NULL",
+                  'value': "1", 'mode': 'settled', 'finished': "true"},
+    # one row per uploaded dataset, so the volume can be grouped by extension
+    'uploads': {'table': "job_to_output_dataset JOIN job ON job.id = job_to_output_dataset.job_id "
+                         "JOIN history_dataset_association ON job_to_output_dataset.dataset_id = history_dataset_association.id "
+                         "LEFT JOIN dataset ON history_dataset_association.dataset_id = dataset.id",
+                'id': "job_to_output_dataset.id", 'time': "job.create_time", 'utc': True,
+                'group': "history_dataset_association.extension", 'value': "coalesce(dataset.total_size, 0)",
+                'where': "job.tool_id = 'upload1'", 'mode': 'settled',
+                'finished': f"coalesce(job.state, '') IN ({FINISHED_JOB_STATES})"},
+}
+
+# rows are read again from this many seconds before the update_time watermark, for transactions that commit late
+SLACK = 300
+# rows read per lookup of their previous bucket
+LOOKUP_ROWS = 500
+
+
+def timestamptz(rollup:{}) -> str:
+    if rollup['utc']:
+        return f"{rollup['time']} AT TIME ZONE 'UTC'"
+    return f"{rollup['time']}::timestamptz"
+
+
+def hour_of(rollup:{}) -> str:
+    return f"floor(extract(epoch FROM {timestamptz(rollup)}) / 3600)::bigint"
+
+
+def compare(rollup:{}, op:str, ts:str) -> str:
+    ''' the time of a rollup compared to a timestamptz, with the conversion on the side of ts so an index
+    on the time column can be used '''
+    if rollup['utc']:
+        return f"{rollup['time']} {op} ({ts}) AT TIME ZONE 'UTC'"
+    return f"{rollup['time']} {op} {ts}"
+
+
+class RollupStore:
+
+    """Hourly buckets of a value per group, summed over the whole hours of a window.
+
+    The rows that were read are kept with their bucket, so a row that is read again, eg a
+    job that changed state, is moved from its old bucket to the new one. Once a row is
+    older than horizon_hours (and finished) it is forgotten. For the tracked rollups,
+    whose rows move between buckets, the buckets are only kept for the horizon, windows
+    that reach back further are not served. The settled rollups keep all their buckets.
+    """
+
+    def __init__(self, path:str, horizon_hours:int=35*24):
+        self.horizon_hours = horizon_hours
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (rollup TEXT, key TEXT, value REAL, PRIMARY KEY (rollup, key))")
+        self._db.execute("CREATE TABLE IF NOT EXISTS buckets (rollup TEXT, hour INTEGER, grp TEXT, value INTEGER, PRIMARY KEY (rollup, hour, grp))")
+        self._db.execute("CREATE TABLE IF NOT EXISTS rows (rollup TEXT, id INTEGER, hour INTEGER, grp TEXT, value INTEGER, finished INTEGER, PRIMARY KEY (rollup, id))")
+
+        # a rollup that was filled by another definition is filled again
+        for name, rollup in ROLLUPS.items():
+            definition = zlib.crc32(repr(sorted(rollup.items())).encode('utf-8'))
+            if self._meta(name, 'definition') != definition:
+                for table in ['meta', 'buckets', 'rows']:
+                    self._db.execute(f"DELETE FROM {table} WHERE rollup = ?", (name,))
+                self._set_meta(name, 'definition', definition)
+        self._db.commit()
+
+    def _meta(self, name:str, key:str) -> float:
+        row = self._db.execute("SELECT value FROM meta WHERE rollup = ? AND key = ?", (name, key)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def _set_meta(self, name:str, key:str, value:float) -> None:
+        self._db.execute("INSERT OR REPLACE INTO meta (rollup, key, value) VALUES (?, ?, ?)", (name, key, value))
+
+    def _apply(self, name:str, rows:list, deltas:{}) -> None:
+        ''' moves the rows (id, hour, grp, value, finished) to their buckets, in deltas until they are written '''
+
+        ids = [row[0] for row in rows]
+        previous = self._db.execute("SELECT id, hour, grp, value FROM rows WHERE rollup = ? AND id IN ({})".format(
+            ", ".join(["?"] * len(ids))), [name] + ids).fetchall()
+        for id, hour, grp, value in previous:
+            deltas[(hour, grp)] = deltas.get((hour, grp), 0) - value
+
+        for id, hour, grp, value, finished in rows:
+            deltas[(hour, grp)] = deltas.get((hour, grp), 0) + value
+
+        self._db.executemany("INSERT OR REPLACE INTO rows (rollup, id, hour, grp, value, finished) VALUES (?, ?, ?, ?, ?, ?)",
+                             [(name, id, hour, grp, value, int(finished)) for id, hour, grp, value, finished in rows])
+
+    def update(self, db, name:str) -> None:
+        ''' reads the rows of a rollup that are new or changed since the last update '''
+
+        rollup = ROLLUPS[name]
+        where = rollup.get('where', "true")
+        finished = rollup.get('finished', "true")
+
+        with self._lock:
+            now_hour = int(time.time() // 3600)
+            watermark = self._meta(name, 'watermark')
+            first_hour = self._meta(name, 'first_hour')
+
+            if rollup['mode'] == 'tracked':
+                if watermark is None:
+                    since = f"now() - INTERVAL '{self.horizon_hours} hours'"
+                    first_hour = now_hour - self.horizon_hours + 1
+                else:
+                    since = f"to_timestamp({watermark - SLACK})"
+                # a time in the future (clock skew) does not move the watermark past now
+                sql = f"SELECT {rollup['id']}, {hour_of(rollup)}, {rollup['group']}, {rollup['value']}, true, "
+                sql += f"least(extract(epoch FROM {timestamptz(rollup)}), extract(epoch FROM now())) "
+                sql += f"FROM {rollup['table']} WHERE {where} AND {compare(rollup, '>=', since)}"
+            else:
+                pending = [id for id, in self._db.execute("SELECT id FROM rows WHERE rollup = ? AND finished = 0", (name,))]
+                if watermark is None:
+                    watermark = 0
+                    first_hour = 0
+                pending = "'{{{}}}'::bigint[]".format(",".join([str(id) for id in pending]))
+                sql = f"SELECT {rollup['id']}, {hour_of(rollup)}, {rollup['group']}, {rollup['value']}, {finished}, {rollup['id']} "
+                sql += f"FROM {rollup['table']} WHERE {where} AND ({rollup['id']} > {int(watermark)} OR {rollup['id']} = ANY({pending}))"
+
+            deltas = {}
+            rows = []
+            for id, hour, grp, value, done, mark in db.stream(sql):
+                rows.append((id, hour, grp or "", int(value or 0), done))
+                watermark = max(watermark or 0, float(mark))
+                if len(rows) >= LOOKUP_ROWS:
+                    self._apply(name, rows, deltas)
+                    rows = []
+            if rows != []:
+                self._apply(name, rows, deltas)
+
+            self._db.executemany("INSERT INTO buckets (rollup, hour, grp, value) VALUES (?, ?, ?, ?) "
+                                 "ON CONFLICT (rollup, hour, grp) DO UPDATE SET value = value + excluded.value",
+                                 [(name, hour, grp, delta) for (hour, grp), delta in deltas.items() if delta != 0])
+
+            # rows that can not move any more are forgotten
+            horizon = now_hour - self.horizon_hours
+            self._db.execute("DELETE FROM rows WHERE rollup = ? AND hour < ? AND finished = 1", (name, horizon))
+            if rollup['mode'] == 'tracked':
+                self._db.execute("DELETE FROM buckets WHERE rollup = ? AND hour < ?", (name, horizon))
+                first_hour = max(first_hour, horizon)
+
+            if watermark is not None:
+                self._set_meta(name, 'watermark', watermark)
+            self._set_meta(name, 'first_hour', first_hour)
+            self._db.commit()
+
+    def covers(self, name:str, hour:int) -> bool:
+        with self._lock:
+            first_hour = self._meta(name, 'first_hour')
+            return first_hour is not None and first_hour <= hour
+
+    def totals(self, name:str, first:int, last:int=None) -> {}:
+        ''' group -> sum of the buckets of the hours first to last (or the latest hour) '''
+        with self._lock:
+            sql = "SELECT grp, sum(value) FROM buckets WHERE rollup = ? AND hour >= ? AND hour <= ? GROUP BY grp"
+            return dict(self._db.execute(sql, (name, first, last if last is not None else 2 ** 62)).fetchall())
+
+    def buckets(self, name:str, first:int=0) -> []:
+        ''' (hour, group, value) of the buckets of a rollup from hour first on, in hour order '''
+        with self._lock:
+            sql = "SELECT hour, grp, value FROM buckets WHERE rollup = ? AND hour >= ? ORDER BY hour, grp"
+            return self._db.execute(sql, (name, first)).fetchall()
+
+    def window(self, db, name:str, start:str) -> {}:
+        ''' group -> value of the rows with a time after start (a timestamptz expression), or None if the
+        rollup does not go back that far. The part of the first hour that is in the window is read from
+        the table, the rest is the sum of the buckets of the whole hours. '''
+
+        rollup = ROLLUPS[name]
+        bounds = db.get_as_dict(f"SELECT extract(epoch FROM {start})::float8 AS start")[0]
+        first = int(bounds['start'] // 3600) + 1
+
+        self.update(db, name)
+        if not self.covers(name, first):
+            return None
+
+        sql = f"SELECT {rollup['group']} AS grp, sum({rollup['value']}) AS value FROM {rollup['table']} "
+        sql += f"WHERE {rollup.get('where', 'true')} AND {compare(rollup, '>', 'to_timestamp({})'.format(bounds['start']))} "
+        sql += f"AND {compare(rollup, '<', 'to_timestamp({})'.format(first * 3600))} GROUP BY 1"
+
+        res = self.totals(name, first)
+        for entry in db.get_as_dict(sql):
+            grp = entry['grp'] or ""
+            res[grp] = res.get(grp, 0) + int(entry['value'] or 0)
+
+        return res
+
+    def close(self) -> None:
+        self._db.close()
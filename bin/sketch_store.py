@@ -0,0 +1,169 @@
+#
+# Per hour HyperLogLog sketches of the users that created jobs, kept in a local sqlite file
+#
+
+import sqlite3
+import threading
+
+import hll
+
+# the hour since the epoch a job was created in
+JOB_HOUR = "floor(extract(epoch FROM create_time AT TIME ZONE 'UTC') / 3600)::bigint"
+
+
+class SketchStore:
+
+    """One sketch per hour, so a distinct user count over any run of whole hours is a merge of sketches.
+
+    The store is filled from the job table in id order, update only reads the jobs after
+    the highest id it has seen, and the jobs of hours from before the oldest hour in the
+    store when a window reaches back further. Adding a user twice does not change a
+    sketch, so rows that are read again do no harm.
+    """
+
+    def __init__(self, path:str, precision:int=12):
+        self.precision = precision
+        self._lock = threading.Lock()
+        # the merge of the closed hours of every window, (first, last) -> sketch
+        self._merged = {}
+
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS sketches (hour INTEGER PRIMARY KEY, registers BLOB)")
+
+        # sketches of another precision do not merge, the store is filled again
+        if self._meta('precision') != precision:
+            self._db.execute("DELETE FROM sketches")
+            self._db.execute("DELETE FROM meta")
+            self._set_meta('precision', precision)
+        self._db.commit()
+
+    def _meta(self, key:str) -> int:
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def _set_meta(self, key:str, value:int) -> None:
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def _load(self, hour:int) -> hll.HyperLogLog:
+        row = self._db.execute("SELECT registers FROM sketches WHERE hour = ?", (hour,)).fetchone()
+        if row is None:
+            return hll.HyperLogLog(self.precision)
+        return hll.HyperLogLog.from_bytes(self.precision, row[0])
+
+    def _save(self, hour:int, sketch:hll.HyperLogLog) -> None:
+        self._db.execute("INSERT OR REPLACE INTO sketches (hour, registers) VALUES (?, ?)", (hour, sketch.to_bytes()))
+        for first, last in [key for key in self._merged if key[0] <= hour <= key[1]]:
+            del self._merged[(first, last)]
+
+    def sketch(self, values:list) -> hll.HyperLogLog:
+        sketch = hll.HyperLogLog(self.precision)
+        for value in values:
+            sketch.add(value)
+        return sketch
+
+    def update(self, db, first_hour:int) -> None:
+        ''' adds the jobs created since the last update, and those from first_hour on if the store starts later '''
+
+        with self._lock:
+            watermark = self._meta('watermark')
+            covered = self._meta('first_hour')
+            create_time = "create_time AT TIME ZONE 'UTC'"
+
+            if watermark is None:
+                where = f"{create_time} >= to_timestamp({first_hour * 3600})"
+                watermark = 0
+                covered = first_hour
+            else:
+                where = f"id > {watermark}"
+                if first_hour < covered:
+                    where += f" OR ({create_time} >= to_timestamp({first_hour * 3600}) AND {create_time} < to_timestamp({covered * 3600}))"
+                    covered = first_hour
+
+            sql = f"SELECT {JOB_HOUR} AS hour, user_id, max(id) FROM job WHERE {where} GROUP BY 1, 2 ORDER BY 1"
+
+            hour = sketch = None
+            for row_hour, user_id, id in db.stream(sql):
+                if row_hour != hour:
+                    if sketch is not None:
+                        self._save(hour, sketch)
+                    hour, sketch = row_hour, self._load(row_hour)
+                if user_id is not None:
+                    sketch.add(user_id)
+                watermark = max(watermark, id)
+
+            if sketch is not None:
+                self._save(hour, sketch)
+
+            self._set_meta('watermark', watermark)
+            self._set_meta('first_hour', covered)
+            self._db.commit()
+
+    def _merge(self, first:int, last:int) -> hll.HyperLogLog:
+        merged = hll.HyperLogLog(self.precision)
+        rows = self._db.execute("SELECT registers FROM sketches WHERE hour >= ? AND hour <= ?", (first, last))
+        for registers, in rows:
+            merged.merge(hll.HyperLogLog.from_bytes(self.precision, registers))
+        return merged
+
+    def union(self, first:int, last:int) -> hll.HyperLogLog:
+        ''' the merge of the sketches of the hours first to last. The hours before last do not change
+        any more, their merge is kept per window for the next call with the same window '''
+
+        with self._lock:
+            key = (first, last - 1)
+            if key not in self._merged:
+                # the windows of an earlier hour do not come back
+                for stale in [stale for stale in self._merged if stale[1] < last - 1]:
+                    del self._merged[stale]
+                self._merged[key] = self._merge(first, last - 1)
+
+            return self._merged[key].copy().merge(self._load(last))
+
+    def sliding(self, windows):
+        ''' the distinct count of every (first, last) hour window, for windows that move forward.
+
+        The hours in the window are kept as a queue of two stacks with running merges, so
+        every hour is merged in about twice instead of once per window it is in. A window
+        that starts before the previous one fills the queue again.
+        '''
+
+        front = []
+        back = []
+        back_merged = hll.HyperLogLog(self.precision)
+        start = end = None
+
+        for first, last in windows:
+            if start is None or first < start or first > end:
+                front, back = [], []
+                back_merged = hll.HyperLogLog(self.precision)
+                start = end = first
+
+            while end <= last:
+                with self._lock:
+                    sketch = self._load(end)
+                back.append(sketch)
+                back_merged.merge(sketch)
+                end += 1
+
+            while start < first:
+                if front == []:
+                    # the front stack holds the merge of each sketch with the ones behind it
+                    merged = hll.HyperLogLog(self.precision)
+                    for sketch in reversed(back):
+                        merged = merged.copy().merge(sketch)
+                        front.append(merged)
+                    back = []
+                    back_merged = hll.HyperLogLog(self.precision)
+                front.pop()
+                start += 1
+
+            total = back_merged.copy()
+            if front != []:
+                total.merge(front[-1])
+            yield total.count()
+
+    def close(self) -> None:
+        self._db.close()